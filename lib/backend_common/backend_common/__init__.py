@@ -3,12 +3,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
+import gc
 import importlib
 import os
+import threading
+import time
 
 import flask
 
 import backend_common.dockerflow
+import cli_common.http
 import cli_common.log
 
 EXTENSIONS = [
@@ -21,10 +26,174 @@ EXTENSIONS = [
     'cache',
     'pulse',
     'db',
+    'aws',
+]
+
+# Extensions initialised on first use rather than at startup: only those
+# used through their `app.<name>` attribute (and nothing else) can be
+DEFERRED_EXTENSIONS = [
+    'pulse',
+    'aws',
 ]
 
 logger = cli_common.log.get_logger(__name__)
 
+# Whether the garbage collector was frozen before a fork (FORK_GC_FREEZE)
+_gc_frozen = False
+
+
+def init_extension(app, extension_name):
+    '''
+    Import and initialise an extension, recording the time spent in
+    app.startup_profile (and logging it with STARTUP_PROFILE)
+    '''
+    logger.debug('Initializing extension', extension=extension_name, app=app.name)
+    start = time.monotonic()
+
+    extension_init_app = None
+    try:
+        extension_init_app = getattr(importlib.import_module('backend_common.' + extension_name), 'init_app')
+    except Exception as e:
+        logger.exception(e)
+        pass
+
+    if extension_init_app is None:
+        raise Exception(f'Could not import backend_common extension: {extension_name}')
+
+    imported = time.monotonic()
+    extension = extension_init_app(app)
+    initialized = time.monotonic()
+
+    profile = app.startup_profile[extension_name] = dict(
+        import_time=round(imported - start, 6),
+        init_time=round(initialized - imported, 6),
+    )
+    if app.config.get('STARTUP_PROFILE'):
+        logger.info('Extension initialized', extension=extension_name, app=app.name, **profile)
+
+    logger.debug('Extension initialized', extension=extension_name, app=app.name)
+    return extension
+
+
+class DeferredExtension(object):
+    '''
+    Placeholder of an extension, initialising it on first use
+    '''
+
+    def __init__(self, app, extension_name):
+        self.app = app
+        self.extension_name = extension_name
+        self._extension = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._extension is None:
+                extension = init_extension(self.app, self.extension_name)
+                if extension is None:
+                    # The extension set its app attribute itself
+                    extension = getattr(self.app, self.extension_name)
+                    if extension is self:
+                        raise Exception(f'Deferred extension {self.extension_name} did not set app.{self.extension_name}')
+                else:
+                    setattr(self.app, self.extension_name, extension)
+                self._extension = extension
+        return self._extension
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def run_fork_hooks(app, hook_name):
+    '''
+    Run a fork hook (`before_fork`, `after_fork` or `after_fork_parent`) of every initialised
+    extension defining it
+    '''
+    for extension_name in EXTENSIONS:
+        extension = getattr(app, extension_name, None)
+        if extension is None:
+            continue
+
+        # Nothing to release in a deferred extension never used
+        if isinstance(extension, DeferredExtension) and extension._extension is None:
+            continue
+
+        hook = getattr(importlib.import_module('backend_common.' + extension_name), hook_name, None)
+        if hook is None:
+            continue
+
+        logger.debug('Running fork hook', extension=extension_name, hook=hook_name, app=app.name)
+        hook(app)
+
+
+def before_fork(app):
+    '''
+    Prepare an application loaded in a master process to be forked into
+    workers: close its connections (database, pulse, aws, http), which must
+    not be shared with the workers, and stop its threads.
+
+    With FORK_GC_FREEZE, the objects of the master are moved once (on the
+    first fork) to the permanent generation of the garbage collector, so
+    the workers do not copy the pages of the master to collect them. They
+    are never collected afterwards.
+
+    With gunicorn, call it from the `pre_fork` server hook (and use
+    `preload_app = True`).
+    '''
+    global _gc_frozen
+
+    run_fork_hooks(app, 'before_fork')
+    cli_common.http.release_connections()
+
+    if app.config.get('FORK_GC_FREEZE', False) and not _gc_frozen:
+        gc.collect()
+        gc.freeze()
+        _gc_frozen = True
+
+
+def after_fork(app):
+    '''
+    Re-arm an application in a forked worker: open new connections and
+    restart the threads (which do not survive a fork) of its extensions.
+
+    With gunicorn, call it from the `post_fork` server hook.
+    '''
+    run_fork_hooks(app, 'after_fork')
+    cli_common.http.release_connections()
+    if hasattr(app, 'heartbeat'):
+        app.heartbeat.after_fork()
+
+
+def after_fork_parent(app):
+    '''
+    Re-arm an application in the process which forked, for when it also
+    serves requests: restart the threads stopped by `before_fork`. Released
+    connections are opened again on use.
+    '''
+    run_fork_hooks(app, 'after_fork_parent')
+
+
+def register_fork_hooks(app):
+    '''
+    Run the fork hooks of an application when the current (master) process
+    forks, but not when its workers fork in turn
+    '''
+    master_pid = os.getpid()
+
+    def before():
+        if os.getpid() == master_pid:
+            before_fork(app)
+
+    def after_in_parent():
+        if os.getpid() == master_pid:
+            after_fork_parent(app)
+
+    def after_in_child():
+        if os.getppid() == master_pid:
+            after_fork(app)
+
+    os.register_at_fork(before=before, after_in_parent=after_in_parent, after_in_child=after_in_child)
+
 
 def create_app(
         project_name,
@@ -40,10 +209,12 @@ def create_app(
     project_name is a "nice" name, used to identify the application
     '''
     logger.debug('Initializing', app=app_name)
+    start = time.monotonic()
 
     app = flask.Flask(import_name=app_name, **kw)
     app.name = project_name
     app.__extensions = extensions
+    app.startup_profile = collections.OrderedDict()
 
     if config:
         app.config.update(**config)
@@ -54,6 +225,11 @@ def create_app(
     if config:
         app.config.update(**config)
 
+    deferred_extensions = app.config.get('DEFERRED_EXTENSIONS', DEFERRED_EXTENSIONS)
+    invalid_extensions = sorted(set(deferred_extensions) - set(DEFERRED_EXTENSIONS))
+    if invalid_extensions:
+        raise Exception(f'Extensions cannot be deferred: {", ".join(invalid_extensions)}')
+
     for extension_name in EXTENSIONS:
         if app.config.get('TESTING') and extension_name in ['security', 'cors']:
             continue
@@ -61,28 +237,24 @@ def create_app(
         if extension_name not in extensions:
             continue
 
-        logger.debug('Initializing extension', extension=extension_name, app=app.name)
-
-        extension_init_app = None
-        try:
-            extension_init_app = getattr(importlib.import_module('backend_common.' + extension_name), 'init_app')
-        except Exception as e:
-            logger.exception(e)
-            pass
-
-        if extension_init_app is None:
-            raise Exception(f'Could not import backend_common extension: {extension_name}')
+        if extension_name in deferred_extensions:
+            logger.debug('Deferring extension', extension=extension_name, app=app.name)
+            setattr(app, extension_name, DeferredExtension(app, extension_name))
+            continue
 
-        extension = extension_init_app(app)
+        extension = init_extension(app, extension_name)
         if extension and extension_name is not None:
             setattr(app, extension_name, extension)
 
-        logger.debug('Extension initialized', extension=extension_name, app=app.name)
-
     if redirect_root_to_api:
         app.add_url_rule('/', 'root', lambda: flask.redirect(app.api.swagger_url))
 
     if enable_dockerflow:
+        app.heartbeat = backend_common.dockerflow.Heartbeat(app, extensions)
+        app.version = backend_common.dockerflow.Version(
+            app.config.get('VERSION_JSON_PATH', backend_common.dockerflow.VERSION_JSON_PATH),
+            reload=app.config.get('VERSION_JSON_RELOAD', False),
+        )
         app.add_url_rule('/__heartbeat__',
                          view_func=backend_common.dockerflow.heartbeat_response)
         app.add_url_rule('/__lbheartbeat__',
@@ -90,5 +262,12 @@ def create_app(
         app.add_url_rule('/__version__',
                          view_func=backend_common.dockerflow.get_version)
 
+    if app.config.get('REGISTER_FORK_HOOKS'):
+        register_fork_hooks(app)
+
+    app.startup_profile['total'] = dict(init_time=round(time.monotonic() - start, 6))
+    if app.config.get('STARTUP_PROFILE'):
+        logger.info('Initialized', app=app.name, **app.startup_profile['total'])
+
     logger.debug('Initialized', app=app.name)
     return app
@@ -3,16 +3,30 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
+import os
 import pathlib
+import random
 
 import connexion
+import connexion.decorators.response
 import flask
 import werkzeug
 
+import backend_common.encoder
 import cli_common.log
 
 logger = cli_common.log.get_logger(__name__)
 
+# Share of responses validated against the specification, per channel
+RESPONSE_VALIDATION_RATES = {
+    'production': 0.01,
+}
+
+STREAM_MIMETYPES = ('application/json', 'application/x-ndjson')
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_YIELD_PER = 1000
+
 
 def common_error_handler(exception):
     '''TODO: add description
@@ -33,6 +47,55 @@ def common_error_handler(exception):
     )
 
 
+def get_response_validation_rate(app):
+    '''Share of responses to validate: API_RESPONSE_VALIDATION_RATE, or the
+       default of the application channel (every response when testing)
+    '''
+    rate = app.config.get('API_RESPONSE_VALIDATION_RATE')
+    if rate is None:
+        if app.config.get('TESTING'):
+            return 1.0
+        channel = app.config.get('APP_CHANNEL') or os.environ.get('APP_CHANNEL')
+        rate = RESPONSE_VALIDATION_RATES.get(channel, 1.0)
+    return float(rate)
+
+
+class SampledResponseValidator(connexion.decorators.response.ResponseValidator):
+    '''Validate a random sample of the responses of an operation
+
+       Streamed responses are never validated, as it would buffer them.
+    '''
+
+    rate = 1.0
+
+    def __call__(self, function):
+        if self.rate <= 0:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(request):
+            response = function(request)
+            if self.rate < 1 and random.random() >= self.rate:
+                return response
+            if isinstance(response, flask.Response) and response.is_streamed:
+                return response
+
+            connexion_response = self.operation.api.get_connexion_response(response, self.mimetype)
+            self.validate_response(
+                connexion_response.body,
+                connexion_response.status_code,
+                connexion_response.headers,
+                request.url,
+            )
+            return response
+
+        return wrapper
+
+
+def get_response_validator(rate):
+    return type('SampledResponseValidator', (SampledResponseValidator, ), dict(rate=rate))
+
+
 class Api:
     '''TODO: add description
        TODO: annotate class
@@ -47,7 +110,7 @@ class Api:
 
         logger.debug('Setting JSON encoder.')
 
-        app.json_encoder = connexion.apps.flask_app.FlaskJSONEncoder
+        app.json_encoder = backend_common.encoder.get_json_encoder(app.config.get('API_JSON_ENCODER', 'auto'))
 
         logger.debug('Setting common error handler for all error codes.')
         for error_code in werkzeug.exceptions.default_exceptions:
@@ -66,15 +129,29 @@ class Api:
                  validator_map=None,
                  pythonic_params=False,
                  pass_context_arg_name=None,
-                 options=None
+                 options=None,
+                 response_validation_rate=None,
                  ):
         '''Adds an API to the application based on a swagger file
+
+           With validate_responses, response_validation_rate (by default
+           from get_response_validation_rate) is the share of responses
+           validated against the specification.
         '''
 
         app = self.__app
 
         logger.debug(f'Adding API: {specification}')
 
+        if validate_responses:
+            if response_validation_rate is None:
+                response_validation_rate = get_response_validation_rate(app)
+            logger.debug('Validating responses', rate=response_validation_rate)
+            if response_validation_rate <= 0:
+                validate_responses = False
+            else:
+                validator_map = dict(validator_map or {}, response=get_response_validator(response_validation_rate))
+
         self.__api = api = connexion.apis.flask_api.FlaskApi(
             specification=pathlib.Path(specification),
             base_path=base_path,
@@ -99,6 +176,56 @@ class Api:
         return api
 
 
+def stream_json(items, serialize=None, mimetype=None, status=200, headers=None, chunk_size=STREAM_CHUNK_SIZE):
+    '''Stream a collection (iterable or SQLAlchemy query) from an operation
+
+       Items are encoded one by one (after `serialize`, when given) into a
+       JSON array or, when the client prefers application/x-ndjson, newline
+       delimited JSON, and sent in chunks of about `chunk_size` bytes. Queries
+       are fetched STREAM_YIELD_PER rows at a time, so memory use does not
+       grow with the size of the response.
+    '''
+
+    if mimetype is None:
+        mimetype = flask.request.accept_mimetypes.best_match(STREAM_MIMETYPES, default=STREAM_MIMETYPES[0])
+
+    if hasattr(items, 'yield_per'):
+        items = items.yield_per(STREAM_YIELD_PER)
+
+    def generate():
+        app = flask.current_app
+        encoder = app.json_encoder(
+            ensure_ascii=app.config.get('JSON_AS_ASCII', True),
+            sort_keys=app.config.get('JSON_SORT_KEYS', True),
+        )
+        ndjson = mimetype == 'application/x-ndjson'
+        chunk = [] if ndjson else ['[']
+        size = 0
+        for index, item in enumerate(items):
+            if serialize is not None:
+                item = serialize(item)
+            data = encoder.encode(item)
+            if ndjson:
+                chunk.extend([data, '\n'])
+            else:
+                chunk.extend([',', data] if index else [data])
+            size += len(data)
+            if size >= chunk_size:
+                yield ''.join(chunk).encode('utf-8')
+                chunk, size = [], 0
+        if not ndjson:
+            chunk.append(']')
+        if chunk:
+            yield ''.join(chunk).encode('utf-8')
+
+    return flask.Response(
+        flask.stream_with_context(generate()),
+        status=status,
+        headers=headers,
+        mimetype=mimetype,
+    )
+
+
 def handle_default_exceptions_raw(e):
     code = getattr(e, 'code', 500)
     description = getattr(e, 'description', str(e))
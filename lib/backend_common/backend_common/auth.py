@@ -3,11 +3,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
+import collections
+import concurrent.futures
 import datetime
 import functools
+import hashlib
 import json
 import os
 import time
+import uuid
 
 import flask
 import flask_login
@@ -16,12 +21,14 @@ import itsdangerous
 import pytz
 import requests
 import sqlalchemy as sa
-import taskcluster.utils
 
 import backend_common.db
 import backend_common.dockerflow
+import backend_common.encoder
+import cli_common.http
 import cli_common.log
 import cli_common.taskcluster
+import cli_common.utils
 
 logger = cli_common.log.get_logger(__name__)
 
@@ -33,6 +40,10 @@ UNAUTHORIZED_JSON = {
     'type': 'about:blank',
 }
 
+AUTH0_USERINFO_CACHE_PREFIX = 'auth0:userinfo:'
+RELENGAPI_TOKEN_VERSION_CACHE_PREFIX = 'relengapi:token:version:'
+AUTHENTICATION_BACKENDS = ('relengapi', 'auth0', 'taskcluster')
+
 
 class BaseUser(object):
 
@@ -72,10 +83,16 @@ class BaseUser(object):
         user_permissions = self.get_permissions()
 
         return all([
-            permission in list(user_permissions)
+            permission in user_permissions
             for permission in permissions
         ])
 
+    def granted_permissions(self, permissions):
+        '''
+        Subset of some permissions granted to the user
+        '''
+        return set(permissions).intersection(self.get_permissions())
+
     def __str__(self):
         return self.get_id()
 
@@ -89,6 +106,60 @@ class AnonymousUser(BaseUser):
         return 'anonymous:'
 
 
+class TaskclusterScopes(object):
+    '''
+    Index of the scopes assumed by a Taskcluster client
+
+    Exact scopes are kept in a set and star scopes in a prefix trie, so
+    checking a required scope costs its length instead of a scan over every
+    assumed scope. Matching follows taskcluster.utils.scopeMatch.
+    '''
+
+    STAR = None
+
+    def __init__(self, scopes):
+        self.exact = set()
+        self.trie = dict()
+        for scope in scopes:
+            if scope.endswith('*'):
+                node = self.trie
+                for char in scope[:-1]:
+                    node = node.setdefault(char, dict())
+                node[self.STAR] = True
+            else:
+                self.exact.add(scope)
+
+    def satisfies(self, required_scope):
+        if required_scope in self.exact:
+            return True
+        node = self.trie
+        for char in required_scope:
+            if self.STAR in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return self.STAR in node
+
+    def match(self, required_scope_sets):
+        '''
+        Check if any of the required scope sets, in disjunctive normal form,
+        is satisfied
+        '''
+        return any(
+            all(self.satisfies(scope) for scope in scope_set)
+            for scope_set in required_scope_sets
+        )
+
+
+@functools.lru_cache(maxsize=256)
+def get_taskcluster_scopes(scopes):
+    '''
+    Share scopes indexes between users assuming the same scopes
+    '''
+    return TaskclusterScopes(scopes)
+
+
 class TaskclusterUser(BaseUser):
 
     type = 'taskcluster'
@@ -110,12 +181,22 @@ class TaskclusterUser(BaseUser):
             raise Exception('credentials["scopes"] should be a list')
 
         self.credentials = credentials
+        self._scopes = None
 
         logger.info(f'Init user {self.get_id()}')
 
     def get_id(self):
         return self.credentials['clientId']
 
+    @property
+    def scopes(self):
+        '''
+        Scopes index, looked up once for the lifetime of this user
+        '''
+        if self._scopes is None:
+            self._scopes = get_taskcluster_scopes(tuple(self.get_permissions()))
+        return self._scopes
+
     def get_permissions(self):
         return self.credentials['scopes']
 
@@ -130,7 +211,10 @@ class TaskclusterUser(BaseUser):
         if not isinstance(permissions[0], (tuple, list)):
             permissions = [permissions]
 
-        return taskcluster.utils.scopeMatch(self.get_permissions(), permissions)
+        return self.scopes.match(permissions)
+
+    def granted_permissions(self, permissions):
+        return set(filter(self.scopes.satisfies, permissions))
 
 
 class Auth0User(BaseUser):
@@ -156,19 +240,39 @@ class Auth0User(BaseUser):
         return self.userinfo['email']
 
     def get_permissions(self):
-        user = self.get_id()
-        all_permissions = flask.current_app.config.get('AUTH0_AUTH_SCOPES', dict())
-        return [
-            permission
-            for permission, users in all_permissions.items()
-            if user in users
-        ]
+        return get_auth0_permissions(flask.current_app).get(self.get_id(), frozenset())
 
     def has_permissions(self, permissions):
         if not isinstance(permissions, (tuple, list)):
             permissions = [permissions]
         user_permissions = self.get_permissions()
-        return all(map(lambda p: p in user_permissions, permissions))
+        return all(p in user_permissions for p in permissions)
+
+
+def build_auth0_permissions(app):
+    '''
+    Index AUTH0_AUTH_SCOPES (permission -> users) by user email
+
+    The index is rebuilt automatically when AUTH0_AUTH_SCOPES is replaced in
+    the app configuration; call this again after modifying it in place.
+    '''
+    scopes = app.config.get('AUTH0_AUTH_SCOPES')
+    permissions = dict()
+    for permission, users in (scopes or dict()).items():
+        for user in users:
+            permissions.setdefault(user, set()).add(permission)
+    app.auth0_permissions = (scopes, {
+        user: frozenset(user_permissions)
+        for user, user_permissions in permissions.items()
+    })
+    return app.auth0_permissions[1]
+
+
+def get_auth0_permissions(app):
+    scopes, permissions = getattr(app, 'auth0_permissions', (None, None))
+    if permissions is None or scopes is not app.config.get('AUTH0_AUTH_SCOPES'):
+        return build_auth0_permissions(app)
+    return permissions
 
 
 class RelengapiTokenUser(BaseUser):
@@ -197,16 +301,129 @@ class RelengapiTokenUser(BaseUser):
         return self._permissions
 
 
+class AuthenticationBackend(object):
+    '''
+    Run the remote validations of an authentication backend
+
+     * concurrent validations sharing a key make a single remote call,
+     * with a pool size, remote calls run in a dedicated I/O thread pool
+       (within an application context) and are waited for at most `timeout`
+       seconds before AuthenticationUnavailable is raised,
+     * remote call latencies are recorded in a histogram.
+    '''
+
+    def __init__(self, name, app=None, pool_size=0, timeout=None):
+        self.name = name
+        self.app = app
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.latency = cli_common.utils.Histogram()
+        self.reset()
+
+    def reset(self):
+        '''
+        Start from new flights and thread pool (e.g. in a forked process,
+        where the threads of the parent do not run)
+        '''
+        self.flight = cli_common.utils.SingleFlight()
+        self.pool = None
+        if self.pool_size > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool_size)
+
+    def _run(self, operation, *args, **kwargs):
+        with self.latency.time():
+            return operation(*args, **kwargs)
+
+    def _run_in_app_context(self, operation, *args, **kwargs):
+        with self.app.app_context():
+            return self._run(operation, *args, **kwargs)
+
+    def _run_in_pool(self, operation, *args, **kwargs):
+        future = self.pool.submit(self._run_in_app_context, operation, *args, **kwargs)
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise AuthenticationUnavailable(f'{self.name} authentication timed out after {self.timeout}s')
+
+    def call(self, key, operation, *args, **kwargs):
+        run = self.pool is None and self._run or self._run_in_pool
+        try:
+            return self.flight.call(
+                key,
+                functools.partial(run, operation, *args, **kwargs),
+                timeout=self.timeout,
+            )
+        except concurrent.futures.TimeoutError:
+            raise AuthenticationUnavailable(f'{self.name} authentication timed out after {self.timeout}s')
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
 class Auth(object):
 
     def __init__(self, anonymous_user):
         self.login_manager = flask_login.LoginManager()
         self.login_manager.anonymous_user = anonymous_user
         self.app = None
+        self.auth0_cache = cli_common.utils.TTLCache(maxsize=0)
+        self.auth0_session = None
+        self.relengapi_cache = cli_common.utils.TTLCache(maxsize=0)
+        self.negative_cache = cli_common.utils.TTLCache(maxsize=0)
+        self.backends = {
+            name: AuthenticationBackend(name)
+            for name in AUTHENTICATION_BACKENDS
+        }
 
     def init_app(self, app):
         self.app = app
         self.login_manager.init_app(app)
+        self.auth0_cache = cli_common.utils.TTLCache(
+            maxsize=app.config.get('AUTH0_AUTH_CACHE_SIZE', 1024),
+            ttl=app.config.get('AUTH0_AUTH_CACHE_TTL', 60),
+        )
+        self.auth0_session = cli_common.http.get_session(
+            'auth0',
+            timeout=app.config.get('AUTH0_AUTH_TIMEOUT', 10),
+            pool_maxsize=app.config.get('AUTH0_AUTH_POOL_SIZE', 10),
+        )
+        self.relengapi_cache = cli_common.utils.TTLCache(
+            maxsize=app.config.get('RELENGAPI_AUTH_CACHE_SIZE', 1024),
+            ttl=app.config.get('RELENGAPI_AUTH_CACHE_TTL', 10),
+        )
+        self.negative_cache = cli_common.utils.TTLCache(
+            maxsize=app.config.get('AUTH_NEGATIVE_CACHE_SIZE', 1024),
+            ttl=app.config.get('AUTH_NEGATIVE_CACHE_TTL', 10),
+        )
+        for backend in self.backends.values():
+            backend.shutdown()
+        self.backends = {
+            name: AuthenticationBackend(
+                name,
+                app=app,
+                pool_size=app.config.get('AUTH_IO_POOL_SIZE', 0),
+                timeout=app.config.get('AUTH_IO_TIMEOUT', 10),
+            )
+            for name in AUTHENTICATION_BACKENDS
+        }
+
+    def stats(self):
+        '''
+        Counters of the authentication caches and latencies of the backends
+        '''
+        return dict(
+            caches=dict(
+                auth0=self.auth0_cache.stats(),
+                relengapi=self.relengapi_cache.stats(),
+                negative=self.negative_cache.stats(),
+            ),
+            backends={
+                name: backend.latency.stats()
+                for name, backend in self.backends.items()
+            },
+        )
 
     def _require_login(self):
         with flask.current_app.app_context():
@@ -306,14 +523,15 @@ def initial_data():
     user = dict()
     user['type'] = flask_login.current_user.type
 
-    user['permissions'] = []
-    for permission, permission_doc in RELENGAPI_PERMISSIONS.items():
-        new_permission = from_relengapi_permission(permission)
-        if flask_login.current_user.has_permissions(new_permission):
-            user['permissions'].append(dict(
-                name=permission,
-                doc=permission_doc,
-            ))
+    granted = flask_login.current_user.granted_permissions(RELENGAPI_PERMISSIONS_REVERSE_MAPPING.keys())
+    user['permissions'] = [
+        dict(
+            name=permission,
+            doc=permission_doc,
+        )
+        for permission, permission_doc in RELENGAPI_PERMISSIONS.items()
+        if RELENGAPI_PERMISSIONS_MAPPING[permission] in granted
+    ]
 
     if getattr(flask_login.current_user, 'authenticated_email', NO_AUTH) != NO_AUTH:
         user['authenticated_email'] = flask_login.current_user.authenticated_email
@@ -324,7 +542,8 @@ def initial_data():
     )
 
 
-def to_relengapi_permission(_permission):
+@functools.lru_cache(maxsize=1024)
+def _to_relengapi_permission(_permission):
     if _permission.startswith('project:releng:services/'):
         permission = _permission[len('project:releng:services/'):]
         for prefix, project in RELENGAPI_PROJECT_PERMISSION_MAPPING.items():
@@ -333,7 +552,8 @@ def to_relengapi_permission(_permission):
     return _permission
 
 
-def from_relengapi_permission(_permission):
+@functools.lru_cache(maxsize=1024)
+def _from_relengapi_permission(_permission):
     permission = _permission.strip().replace('.', '/')
     for prefix, project in RELENGAPI_PROJECT_PERMISSION_MAPPING.items():
         if permission.startswith(prefix):
@@ -341,6 +561,73 @@ def from_relengapi_permission(_permission):
     return _permission
 
 
+# Translations of the known relengapi permissions, in both directions
+RELENGAPI_PERMISSIONS_MAPPING = {
+    permission: _from_relengapi_permission(permission)
+    for permission in RELENGAPI_PERMISSIONS
+}
+RELENGAPI_PERMISSIONS_REVERSE_MAPPING = {
+    permission: relengapi_permission
+    for relengapi_permission, permission in RELENGAPI_PERMISSIONS_MAPPING.items()
+}
+
+
+def to_relengapi_permission(_permission):
+    try:
+        return RELENGAPI_PERMISSIONS_REVERSE_MAPPING[_permission]
+    except KeyError:
+        return _to_relengapi_permission(_permission)
+
+
+def from_relengapi_permission(_permission):
+    try:
+        return RELENGAPI_PERMISSIONS_MAPPING[_permission]
+    except KeyError:
+        return _from_relengapi_permission(_permission)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_relengapi_permissions(permissions):
+    '''
+    Parse the comma joined permissions stored in a RelengapiToken
+    '''
+    return tuple(
+        from_relengapi_permission(permission)
+        for permission in permissions.split(',')
+        if permission
+    )
+
+
+class RelengapiTokenData(collections.namedtuple('RelengapiTokenData', 'id typ description user disabled permissions')):
+    '''
+    Detached, immutable copy of a RelengapiToken row, safe to share between
+    requests through the relengapi tokens cache
+    '''
+
+    @classmethod
+    def from_token(cls, token):
+        return cls(
+            id=token.id,
+            typ=token.typ,
+            description=token.description,
+            user=token.user,
+            disabled=token.disabled,
+            permissions=parse_relengapi_permissions(token._permissions),
+        )
+
+    def to_dict(self):
+        tok = dict(
+            id=self.id,
+            typ=self.typ,
+            description=self.description,
+            permissions=[str(a) for a in self.permissions],
+            disabled=self.disabled
+        )
+        if self.user:
+            tok['user'] = self.user
+        return tok
+
+
 class RelengapiToken(backend_common.db.db.Model):
     __tablename__ = 'relengapi_auth_tokens'
 
@@ -358,34 +645,169 @@ class RelengapiToken(backend_common.db.db.Model):
 
     @property
     def permissions(self):
-        return [
-            from_relengapi_permission(permission)
-            for permission in self._permissions.split(',')
-            if permission
-        ]
+        return list(parse_relengapi_permissions(self._permissions))
 
     def to_dict(self):
-        tok = dict(
-            id=self.id,
-            typ=self.typ,
-            description=self.description,
-            permissions=[str(a) for a in self.permissions],
-            disabled=self.disabled
-        )
-        if self.user:
-            tok['user'] = self.user
-        return tok
+        return RelengapiTokenData.from_token(self).to_dict()
 
 
-def parse_header_taskcluster(request):
+def get_relengapi_shared_cache():
+    if not flask.has_app_context() or flask.current_app.config.get('RELENGAPI_AUTH_CACHE_SHARED', True) is not True:
+        return None
+    return getattr(flask.current_app, 'cache', None)
+
+
+def get_relengapi_token_version(token_id):
+    '''
+    Version of a relengapi token in the `cache` extension, shared by every
+    worker and changed by every update of the token
+    '''
+    shared_cache = get_relengapi_shared_cache()
+    if shared_cache is None:
+        return None
+    key = f'{RELENGAPI_TOKEN_VERSION_CACHE_PREFIX}{token_id}'
+    version = shared_cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        shared_cache.set(key, version, timeout=0)
+    return version
+
+
+def invalidate_relengapi_token(token_id):
+    '''
+    Drop a relengapi token from the cache of this process and, through the
+    shared version, from the cache of every other worker
+    '''
+    auth.relengapi_cache.delete(token_id)
+    shared_cache = get_relengapi_shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete(f'{RELENGAPI_TOKEN_VERSION_CACHE_PREFIX}{token_id}')
+
+
+@sa.event.listens_for(RelengapiToken, 'after_update')
+@sa.event.listens_for(RelengapiToken, 'after_delete')
+def _invalidate_relengapi_token(mapper, connection, target):
+    # Drop the token right away, and again once the change is committed so
+    # a concurrent request can not cache the previous row in the meantime
+    invalidate_relengapi_token(target.id)
+    session = sa.orm.object_session(target)
+    if session is not None:
+        session.info.setdefault('_relengapi_invalidated', set()).add(target.id)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_commit')
+def _invalidate_relengapi_tokens(session):
+    for token_id in session.info.pop('_relengapi_invalidated', set()):
+        invalidate_relengapi_token(token_id)
+
+
+def get_relengapi_token(token_id):
+    '''
+    Load a relengapi token, through the relengapi tokens cache
+
+    Cached copies are only used while the version of the token in the
+    `cache` extension is unchanged, so updated or deleted tokens are
+    reloaded by every worker. Without the `cache` extension (or with
+    RELENGAPI_AUTH_CACHE_SHARED set to False), other processes see the
+    change after RELENGAPI_AUTH_CACHE_TTL.
+    '''
+    version = get_relengapi_token_version(token_id)
+    cached = auth.relengapi_cache.get(token_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    token_data = auth.backends['relengapi'].call(token_id, load_relengapi_token, token_id)
+    if token_data is None:
+        return None
+    auth.relengapi_cache.set(token_id, (version, token_data))
+    return token_data
+
+
+def load_relengapi_token(token_id):
+    token = RelengapiToken.query.filter_by(id=token_id).first()
+    if token is None:
+        return None
+    return RelengapiTokenData.from_token(token)
+
+
+class AuthenticationUnavailable(Exception):
+    '''
+    An authentication backend could not be reached, as opposed to rejecting
+    the provided credentials
+    '''
+
+
+Authorization = collections.namedtuple('Authorization', 'header scheme token')
+
+
+def get_authorization(request):
+    '''
+    Read the Authorization (or Authentication) header once, split into its
+    lowercased scheme and its token (None unless the header has two parts)
+    '''
     auth_header = request.headers.get('Authorization')
     if not auth_header:
         auth_header = request.headers.get('Authentication')
     if not auth_header:
+        return None
+
+    parts = auth_header.split()
+    return Authorization(
+        header=auth_header,
+        scheme=parts[0].lower(),
+        token=len(parts) == 2 and parts[1] or None,
+    )
+
+
+def decode_relengapi_token(token):
+    '''
+    Claims of a relengapi token: a JSON Web Signature of this application
+    issued by relengapi. None for other tokens, including HMAC signed Auth0
+    access tokens, which are left to the other backends.
+    '''
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        header = parts[0] + '=' * (-len(parts[0]) % 4)
+        header = json.loads(base64.urlsafe_b64decode(header).decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(header, dict) or not str(header.get('alg', '')).startswith('HS'):
+        return None
+
+    try:
+        claims = flask.current_app.auth_relengapi_serializer.loads(token)
+    except Exception:
+        return None
+    if not isinstance(claims, dict):
+        return None
+
+    # convert v1 to ra2
+    if claims.get('v') == 1:
+        claims = {'iss': 'ra2', 'typ': 'prm', 'jti': 't%d' % claims['id']}
+
+    if claims.get('iss') != RELENGAPI_TOKENAUTH_ISSUER:
+        return None
+    return claims
+
+
+def is_relengapi_token(token):
+    return decode_relengapi_token(token) is not None
+
+
+def parse_header_taskcluster(request):
+    authorization = get_authorization(request)
+    if authorization is None or authorization.scheme != 'hawk':
         return NO_AUTH
-    if not auth_header.startswith('Hawk'):
+
+    try:
+        return authenticate_taskcluster(request, authorization.header)
+    except AuthenticationUnavailable:
         return NO_AUTH
 
+
+def authenticate_taskcluster(request, auth_header):
     # Get Endpoint configuration
     if ':' in request.host:
         host, port = request.host.split(':')
@@ -406,14 +828,19 @@ def parse_header_taskcluster(request):
     }
 
     # Auth with taskcluster
-    auth = cli_common.taskcluster.get_service('auth', **get_taskcluster_credentials())
+    auth_service = get_taskcluster_service('auth', **get_taskcluster_credentials())
     try:
-        resp = auth.authenticateHawk(payload)
-        if not resp.get('status') == 'auth-success':
-            raise Exception('Taskcluster rejected the authentication')
+        # Every Hawk header is validated: a result is never shared with
+        # another request, which could be a replay
+        resp = auth.backends['taskcluster'].call(object(), auth_service.authenticateHawk, payload)
     except Exception as e:
         logger.error(f'TC auth error: {e}')
         logger.error(f'TC auth details: {payload}')
+        raise AuthenticationUnavailable(e)
+
+    if not resp.get('status') == 'auth-success':
+        logger.error('TC auth error: Taskcluster rejected the authentication')
+        logger.error(f'TC auth details: {payload}')
         return NO_AUTH
 
     return TaskclusterUser(resp)
@@ -438,34 +865,96 @@ def parse_header_auth0(request):
 
         token = parts[1]
 
-    auth_domain = flask.current_app.config.get('AUTH_DOMAIN')
+    try:
+        return authenticate_auth0(token)
+    except AuthenticationUnavailable:
+        return NO_AUTH
+
+
+def authenticate_auth0(token):
+    userinfo = get_auth0_userinfo(token)
+    if userinfo is None:
+        return NO_AUTH
+
+    return Auth0User(token, userinfo)
+
+
+def get_auth0_userinfo(token):
+    '''
+    Validate an Auth0 access token through the userinfo endpoint
+
+    Valid tokens are cached per process, keyed on a hash of the token, and
+    optionally in the `cache` extension (AUTH0_AUTH_CACHE_SHARED) so every
+    worker benefits from a single validation.
+    '''
+    config = flask.current_app.config
+    cache_key = AUTH0_USERINFO_CACHE_PREFIX + hashlib.sha256(token.encode('utf-8')).hexdigest()
+    shared_cache = None
+    if config.get('AUTH0_AUTH_CACHE_SHARED') is True:
+        shared_cache = getattr(flask.current_app, 'cache', None)
+
+    userinfo = auth.auth0_cache.get(cache_key)
+    if userinfo is not None:
+        return userinfo
+
+    if shared_cache is not None:
+        userinfo = shared_cache.get(cache_key)
+        if userinfo is not None:
+            auth.auth0_cache.set(cache_key, userinfo)
+            return userinfo
+
+    auth_domain = config.get('AUTH_DOMAIN')
     url = auth0.client_secrets.get('userinfo_uri', f'https://{auth_domain}/userinfo')
 
     payload = {'access_token': token}
-    response = requests.get(url, params=payload)
+    try:
+        response = auth.backends['auth0'].call(
+            cache_key,
+            auth.auth0_session.get,
+            url,
+            params=payload,
+            timeout=config.get('AUTH0_AUTH_TIMEOUT', 10),
+        )
+    except (requests.exceptions.RequestException, AuthenticationUnavailable) as e:
+        logger.error(f'Auth0 userinfo error: {e}')
+        raise AuthenticationUnavailable(e)
 
     # Because auth0 returns http 200 even if the token is invalid.
-    if response.content == b'Unauthorized' or not response.ok:
-        return NO_AUTH
+    if response.content == b'Unauthorized' or response.status_code == 401:
+        return None
+
+    # Rate limited, or unavailable: the token may be valid
+    if not response.ok:
+        logger.error(f'Auth0 userinfo error: HTTP {response.status_code}')
+        raise AuthenticationUnavailable(f'Auth0 userinfo answered HTTP {response.status_code}')
 
     userinfo = json.loads(str(response.content, 'utf-8'))
 
-    return Auth0User(token, userinfo)
+    auth.auth0_cache.set(cache_key, userinfo)
+    if shared_cache is not None:
+        shared_cache.set(cache_key, userinfo, timeout=auth.auth0_cache.ttl)
 
+    return userinfo
 
-def parse_header_relengapi(request):
 
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        auth_header = request.headers.get('Authentication')
-    if not auth_header:
+def parse_header_relengapi(request):
+    authorization = get_authorization(request)
+    if authorization is None or authorization.token is None:
         return NO_AUTH
 
-    header = auth_header.split()
-    if len(header) != 2:
+    try:
+        return authenticate_relengapi(authorization.token)
+    except AuthenticationUnavailable:
         return NO_AUTH
 
-    token_str = header[1]
+
+def authenticate_relengapi(token_str, claims=None):
+    '''
+    Authenticate a relengapi token, from its claims when already decoded
+    (see decode_relengapi_token)
+    '''
+    if claims is not None:
+        return authenticate_relengapi_claims(claims)
 
     try:
         claims = flask.current_app.auth_relengapi_serializer.loads(token_str)
@@ -486,9 +975,13 @@ def parse_header_relengapi(request):
     if claims.get('iss') != RELENGAPI_TOKENAUTH_ISSUER:
         return NO_AUTH
 
+    return authenticate_relengapi_claims(claims)
+
+
+def authenticate_relengapi_claims(claims):
     if claims['typ'] == 'prm':
         token_id = jti2id(claims['jti'])
-        token_data = RelengapiToken.query.filter_by(id=token_id).first()
+        token_data = get_relengapi_token(token_id)
         if token_data:
             assert token_data.typ == 'prm'
             return RelengapiTokenUser(claims,
@@ -503,7 +996,7 @@ def parse_header_relengapi(request):
 
     elif claims['typ'] == 'usr':
         token_id = jti2id(claims['jti'])
-        token_data = RelengapiToken.query.filter_by(id=token_id).first()
+        token_data = get_relengapi_token(token_id)
         if token_data and not token_data.disabled:
             assert token_data.typ == 'usr'
             return RelengapiTokenUser(claims,
@@ -564,6 +1057,14 @@ def str_to_claims(token_str):
     return claims
 
 
+@functools.lru_cache(maxsize=None)
+def get_taskcluster_service(service_name, client_id=None, access_token=None):
+    '''
+    Build a Taskcluster service client once per set of credentials
+    '''
+    return cli_common.taskcluster.get_service(service_name, client_id, access_token)
+
+
 def get_taskcluster_credentials():
     if flask.current_app.config['TESTING'] is True:
         return dict(
@@ -578,25 +1079,74 @@ def get_taskcluster_credentials():
     )
 
 
+def get_authentication_backend(request):
+    '''
+    Pick the single authentication backend able to validate a request,
+    from the shape (and for relengapi tokens, the signature) of its
+    credentials, returned along with the decoded relengapi token claims
+    '''
+    config = flask.current_app.config
+    authorization = get_authorization(request)
+
+    if config.get('RELENGAPI_AUTH') is True and \
+       authorization is not None and \
+       authorization.token is not None:
+        claims = decode_relengapi_token(authorization.token)
+        if claims is not None:
+            return 'relengapi', authorization.token, claims
+
+    if config.get('AUTH0_AUTH') is True:
+        if 'access_token' in request.form:
+            return 'auth0', request.form['access_token'], None
+        if 'access_token' in request.args:
+            return 'auth0', request.args['access_token'], None
+        if authorization is not None and \
+           authorization.scheme == 'bearer' and \
+           authorization.token is not None:
+            return 'auth0', authorization.token, None
+
+    if config.get('TASKCLUSTER_AUTH', True) is True and \
+       authorization is not None and \
+       authorization.scheme == 'hawk':
+        return 'taskcluster', authorization.header, None
+
+    return None, None, None
+
+
 @auth.login_manager.request_loader
 def parse_header(request):
     '''Parse header and try to authenticate
+
+    The credentials are routed straight to the backend matching their scheme.
+    Rejected credentials are remembered for AUTH_NEGATIVE_CACHE_TTL seconds
+    so repeated bad tokens do not reach the backends again.
     '''
+    backend, credentials, claims = get_authentication_backend(request)
+    if backend is None:
+        return None
 
-    if flask.current_app.config.get('RELENGAPI_AUTH') is True:
-        user = parse_header_relengapi(request)
-        if user != NO_AUTH:
-            return user
+    cache_key = (backend, hashlib.sha256(credentials.encode('utf-8')).hexdigest())
+    if backend == 'taskcluster':
+        # Hawk headers are only valid for the request they were built for
+        cache_key += (request.method, request.path)
+    if auth.negative_cache.get(cache_key) is not None:
+        return None
 
-    if flask.current_app.config.get('AUTH0_AUTH') is True:
-        user = parse_header_auth0(request)
-        if user != NO_AUTH:
-            return user
+    try:
+        if backend == 'relengapi':
+            user = authenticate_relengapi(credentials, claims)
+        elif backend == 'auth0':
+            user = authenticate_auth0(credentials)
+        else:
+            user = authenticate_taskcluster(request, credentials)
+    except AuthenticationUnavailable:
+        return None
 
-    if flask.current_app.config.get('TASKCLUSTER_AUTH', True) is True:
-        user = parse_header_taskcluster(request)
-        if user != NO_AUTH:
-            return user
+    if user is None or user == NO_AUTH:
+        auth.negative_cache.set(cache_key, True)
+        return None
+
+    return user
 
 
 def get_permissions():
@@ -609,11 +1159,11 @@ def get_permissions():
 
     if user.is_authenticated:
         response['user_id'] = user.get_id()
-        response['permissions'] = user.get_permissions()
+        response['permissions'] = sorted(user.get_permissions())
 
     return flask.Response(
         status=200,
-        response=json.dumps(response),
+        response=backend_common.encoder.dumps(response),
         headers={
             'Content-Type': 'application/json',
             'Cache-Control': 'public, max-age=60',
@@ -630,6 +1180,7 @@ def init_app(app):
 
     if app.config.get('AUTH0_AUTH') is True:
         auth0.init_app(app)
+        build_auth0_permissions(app)
 
     auth.init_app(app)
 
@@ -638,19 +1189,24 @@ def init_app(app):
     return auth
 
 
+def after_fork(app):
+    for backend in app.auth.backends.values():
+        backend.reset()
+
+
 def app_heartbeat():
     config = flask.current_app.config
 
     if config.get('AUTH0_AUTH') is True:
         try:
-            r = requests.get('https://auth.mozilla.auth0.com/test')
+            r = cli_common.http.get_session().get('https://auth.mozilla.auth0.com/test')
             assert 'clock' in r.json()
         except Exception as e:
             logger.exception(e)
             raise backend_common.dockerflow.HeartbeatException('Cannot connect to the mozilla auth0 service.')
 
     if config.get('TASKCLUSTER_AUTH') is True:
-        auth = cli_common.taskcluster.get_service('auth', **get_taskcluster_credentials())
+        auth = get_taskcluster_service('auth', **get_taskcluster_credentials())
         try:
             ping = auth.ping()
             assert ping['alive'] is True
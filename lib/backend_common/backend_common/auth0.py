@@ -21,8 +21,8 @@ import time
 import urllib.parse
 
 import flask
-import requests
 
+import cli_common.http
 import cli_common.log
 
 logger = cli_common.log.get_logger(__name__)
@@ -111,7 +111,7 @@ def auth0_check():
         'client_secret': flask.current_app.config.get('AUTH_CLIENT_SECRET'),
         'redirect_uri': flask.current_app.config.get('AUTH_REDIRECT_URI'),
     }
-    auth = requests.post(url, payload)
+    auth = cli_common.http.get_session().post(url, payload)
     if not auth.ok:
         # Forward error
         return auth.json(), auth.status_code
@@ -29,6 +29,15 @@ class AWS(object):
         self._queues = {}
         self._listeners = []
 
+    def reset(self):
+        '''
+        Forget every connection (and queue), new ones are made on next use
+        '''
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+        self._queues = {}
+
     def connect_to(self, service_name, region_name):
         key = service_name, region_name
         if key in self._connections:
@@ -145,5 +154,13 @@ def init_app(app):
         logging.getLogger('boto').setLevel(logging.INFO)
 
 
+def before_fork(app):
+    app.aws.reset()
+
+
+def after_fork(app):
+    app.aws.reset()
+
+
 def app_heartbeat():
     pass
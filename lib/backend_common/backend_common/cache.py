@@ -3,34 +3,579 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
+import hashlib
+import json
+import pickle
+import re
+import threading
+import time
 import uuid
 
 import flask
 import flask_caching
+import flask_caching.backends.base
+import flask_login
+import werkzeug.utils
 
 import backend_common.dockerflow
 import cli_common.log
+import cli_common.utils
 
 logger = cli_common.log.get_logger(__name__)
 cache = flask_caching.Cache()
 
+HEARTBEAT_KEY_PREFIX = 'heartbeat:'
+OTHER_PREFIX = 'other'
+INVALIDATION_CHANNEL = 'backend_common.cache.invalidate'
+RESPONSE_KEY_PREFIX = 'response:'
+
+
+class InstrumentedCache(object):
+    '''
+    Cache backend proxy counting hits, misses, sets, deletes, errors and
+    latency per key prefix (everything up to the first separator).
+
+    The number of tracked prefixes is bounded, extra ones are counted under
+    `other`.
+    '''
+
+    def __init__(self, backend, separators=':/', max_prefixes=100):
+        self.backend = backend
+        self.name = type(backend).__name__
+        self.max_prefixes = max_prefixes
+        self.prefix_regex = re.compile('^[^{}]*'.format(re.escape(separators)))
+        self.prefixes = dict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get_prefix(self, key):
+        return self.prefix_regex.match(str(key)).group(0) or OTHER_PREFIX
+
+    def _counters(self, prefix):
+        counters = self.prefixes.get(prefix)
+        if counters is None:
+            if len(self.prefixes) >= self.max_prefixes:
+                prefix = OTHER_PREFIX
+            counters = self.prefixes.setdefault(prefix, dict(
+                hits=0,
+                misses=0,
+                sets=0,
+                deletes=0,
+                errors=0,
+                latency=cli_common.utils.Histogram(),
+            ))
+        return counters
+
+    def _call(self, keys, method, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            result = getattr(self.backend, method)(*args, **kwargs)
+        except Exception:
+            self._record(keys, 'errors', time.monotonic() - start)
+            raise
+        latency = time.monotonic() - start
+
+        if method in ('get', 'has'):
+            self._record(keys, 'misses' if result is None or result is False else 'hits', latency)
+        elif method == 'get_many':
+            with self._lock:
+                for key, value in zip(keys, result):
+                    self._counters(self.get_prefix(key))['misses' if value is None else 'hits'] += 1
+            self._observe(keys, latency)
+        elif method in ('set', 'add', 'set_many'):
+            self._record(keys, 'sets', latency)
+        elif method in ('delete', 'delete_many'):
+            self._record(keys, 'deletes', latency)
+        return result
+
+    def _record(self, keys, event, latency):
+        with self._lock:
+            for key in keys:
+                self._counters(self.get_prefix(key))[event] += 1
+        self._observe(keys, latency)
+
+    def _observe(self, keys, latency):
+        with self._lock:
+            histograms = {
+                id(counters['latency']): counters['latency']
+                for counters in [self._counters(self.get_prefix(key)) for key in keys]
+            }
+        for histogram in histograms.values():
+            histogram.observe(latency)
+
+    def get(self, key):
+        return self._call([key], 'get', key)
+
+    def has(self, key):
+        return self._call([key], 'has', key)
+
+    def get_many(self, *keys):
+        return self._call(keys, 'get_many', *keys)
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set(self, key, *args, **kwargs):
+        return self._call([key], 'set', key, *args, **kwargs)
+
+    def add(self, key, *args, **kwargs):
+        return self._call([key], 'add', key, *args, **kwargs)
+
+    def set_many(self, mapping, *args, **kwargs):
+        return self._call(list(mapping.keys()), 'set_many', mapping, *args, **kwargs)
+
+    def delete(self, key):
+        return self._call([key], 'delete', key)
+
+    def delete_many(self, *keys):
+        return self._call(keys, 'delete_many', *keys)
+
+    def stats(self):
+        with self._lock:
+            prefixes = {
+                prefix: dict(counters)
+                for prefix, counters in self.prefixes.items()
+            }
+        for counters in prefixes.values():
+            counters['latency'] = counters['latency'].stats()
+        return prefixes
+
+
+class TieredCache(flask_caching.backends.base.BaseCache):
+    '''
+    Bounded in-process LRU in front of a shared (remote) cache backend.
+
+    Values are kept pickled in the local tier, at most `local_ttl` seconds,
+    which bounds how stale a worker can be. With an invalidation client
+    (redis), writes are published so other workers drop their local copy.
+    '''
+
+    def __init__(self,
+                 remote,
+                 local_size=1024,
+                 local_ttl=5,
+                 default_timeout=300,
+                 invalidation_client=None,
+                 invalidation_channel=INVALIDATION_CHANNEL,
+                 ):
+        super(TieredCache, self).__init__(default_timeout)
+        self.remote = remote
+        self.local = cli_common.utils.TTLCache(maxsize=local_size, ttl=local_ttl)
+        self.local_ttl = local_ttl
+        self.id = uuid.uuid4().hex
+        self.invalidation_client = invalidation_client
+        self.invalidation_channel = invalidation_channel
+        self._listener = None
+        self._pubsub = None
+        self._stopping = threading.Event()
+
+    def _local_ttl(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        if timeout > 0:
+            return min(timeout, self.local_ttl)
+        return self.local_ttl
+
+    def _local_get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def _local_set(self, key, value, timeout=None):
+        if value is not None:
+            self.local.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._local_ttl(timeout))
+
+    def get(self, key):
+        value = self._local_get(key)
+        if value is None:
+            value = self.remote.get(key)
+            self._local_set(key, value)
+        return value
+
+    def get_many(self, *keys):
+        values = [self._local_get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            remote_values = dict(zip(missing, self.remote.get_many(*missing)))
+            for key, value in remote_values.items():
+                self._local_set(key, value)
+            values = [remote_values.get(key) if value is None else value for key, value in zip(keys, values)]
+        return values
+
+    def has(self, key):
+        return self.local.get(key, count=False) is not None or self.remote.has(key)
+
+    def set(self, key, value, timeout=None):
+        result = self.remote.set(key, value, timeout=timeout)
+        self._local_set(key, value, timeout)
+        self.publish([key])
+        return result
+
+    def add(self, key, value, timeout=None):
+        result = self.remote.add(key, value, timeout=timeout)
+        if result:
+            self._local_set(key, value, timeout)
+            self.publish([key])
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        result = self.remote.set_many(mapping, timeout=timeout)
+        for key, value in mapping.items():
+            self._local_set(key, value, timeout)
+        self.publish(list(mapping.keys()))
+        return result
+
+    def delete(self, key):
+        self.local.delete(key)
+        result = self.remote.delete(key)
+        self.publish([key])
+        return result
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        result = self.remote.delete_many(*keys)
+        self.publish(list(keys))
+        return result
+
+    def inc(self, key, delta=1):
+        self.local.delete(key)
+        result = self.remote.inc(key, delta=delta)
+        self.publish([key])
+        return result
+
+    def dec(self, key, delta=1):
+        self.local.delete(key)
+        result = self.remote.dec(key, delta=delta)
+        self.publish([key])
+        return result
+
+    def clear(self):
+        self.local.clear()
+        result = self.remote.clear()
+        self.publish(None)
+        return result
+
+    def publish(self, keys):
+        '''
+        Notify other workers these keys (or every key, with None) changed
+        '''
+        if self.invalidation_client is None:
+            return
+        try:
+            self.invalidation_client.publish(
+                self.invalidation_channel,
+                json.dumps(dict(sender=self.id, keys=keys)),
+            )
+        except Exception as e:
+            # Other workers catch up once their local copy expires
+            logger.warning('Cannot publish cache invalidation', error=str(e))
+
+    def invalidate(self, message):
+        '''
+        Drop the local copy of keys changed by another worker
+        '''
+        data = json.loads(message)
+        if data['sender'] == self.id:
+            return
+        if data['keys'] is None:
+            self.local.clear()
+        else:
+            for key in data['keys']:
+                self.local.delete(key)
+
+    def listen(self):
+        '''
+        Start a thread applying invalidations published by other workers
+        '''
+        if self.invalidation_client is None or self._listener is not None:
+            return
+        self._stopping.clear()
+        self._listener = threading.Thread(
+            target=self._listen,
+            name='cache-invalidation',
+            daemon=True,
+        )
+        self._listener.start()
+
+    def stop(self):
+        '''
+        Stop the invalidation listener, e.g. before a fork so the child does
+        not inherit a lock of the local tier held by its thread
+        '''
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        self._stopping.set()
+        pubsub = self._pubsub
+        if pubsub is not None:
+            pubsub.close()
+        listener.join(timeout=5)
+
+    def after_fork(self):
+        '''
+        Restart the invalidation listener in a forked process
+        '''
+        self._listener = None
+        self._pubsub = None
+        self.listen()
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            try:
+                self._pubsub = pubsub = self.invalidation_client.pubsub(ignore_subscribe_messages=True)
+                if self._stopping.is_set():
+                    break
+                pubsub.subscribe(self.invalidation_channel)
+                # Invalidations may have been missed while disconnected
+                self.local.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.invalidate(message['data'])
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                logger.warning('Cache invalidation listener failed', error=str(e))
+                time.sleep(1)
+        self._pubsub = None
+
+
+def get_backend_factory(cache_type):
+    '''
+    Resolve a backend factory the way flask_caching does for CACHE_TYPE
+    '''
+    if '.' not in cache_type:
+        return getattr(flask_caching.backends, cache_type)
+    return werkzeug.utils.import_string(cache_type)
+
+
+def tiered(app, config, args, kwargs):
+    '''
+    Factory of TieredCache, used with CACHE_TYPE=backend_common.cache.tiered
+
+    The remote tier is configured as usual for CACHE_REMOTE_TYPE (redis by
+    default), the local one with CACHE_LOCAL_SIZE and CACHE_LOCAL_TTL.
+    CACHE_INVALIDATION enables pub/sub invalidation through the redis client.
+    '''
+    remote = get_backend_factory(config.get('CACHE_REMOTE_TYPE', 'redis'))(app, config, args, dict(kwargs))
+
+    invalidation_client = None
+    if config.get('CACHE_INVALIDATION', False):
+        invalidation_client = getattr(remote, '_write_client', None)
+        if invalidation_client is None:
+            logger.warning('Cache invalidation needs a redis remote backend', backend=type(remote).__name__)
+
+    backend = TieredCache(
+        remote,
+        local_size=config.get('CACHE_LOCAL_SIZE', 1024),
+        local_ttl=config.get('CACHE_LOCAL_TTL', 5),
+        default_timeout=kwargs.get('default_timeout', 300),
+        invalidation_client=invalidation_client,
+        invalidation_channel=config.get('CACHE_INVALIDATION_CHANNEL', INVALIDATION_CHANNEL),
+    )
+    backend.listen()
+    return backend
+
+
+def get_response_cache_name(operation):
+    if isinstance(operation, str):
+        return operation
+    return getattr(operation, 'response_cache_name', f'{operation.__module__}.{operation.__name__}')
+
+
+def get_response_cache_generation(name):
+    '''
+    Current generation of the cached responses of an operation, changed by
+    invalidate_responses so every older key is ignored
+    '''
+    key = f'{RESPONSE_KEY_PREFIX}generation:{name}'
+    generation = cache.get(key)
+    if generation is None:
+        # `add` cannot be used: with no timeout, RedisCache expires the key
+        # at once. Concurrent first requests may each set a generation,
+        # which only costs them a cache miss.
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, timeout=0)
+    return generation
+
+
+def get_response_cache_key(name, kwargs, vary_on_user=True):
+    user = permissions = None
+    if vary_on_user:
+        current_user = flask_login.current_user
+        user = current_user.get_id()
+        # A granted or revoked permission changes the key
+        get_permissions = getattr(current_user, 'get_permissions', None)
+        if get_permissions is not None:
+            permissions = sorted(str(permission) for permission in get_permissions())
+    data = json.dumps(
+        [
+            sorted((key, repr(value)) for key, value in kwargs.items()),
+            sorted(flask.request.args.items(multi=True)),
+            user,
+            permissions,
+        ],
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    generation = get_response_cache_generation(name)
+    return f'{RESPONSE_KEY_PREFIX}{name}:{generation}:{digest}'
+
+
+def cached_response(timeout=None, name=None, vary_on_user=True):
+    '''
+    Cache the serialised JSON response of a GET API operation
+
+    Responses are stored per operation, arguments and (unless vary_on_user
+    is False) user and permissions, served with a strong ETag and answered
+    with a 304 when the client sent a matching If-None-Match. Only plain 200
+    responses (a body, or a body and a 200 status) are cached. Write
+    operations should call invalidate_responses, or use the
+    invalidates_responses decorator.
+
+    A cached response is served without calling the operation: permission
+    checks must be applied outside (above) this decorator, e.g.
+
+        @auth.require_permissions([...])
+        @cached_response(timeout=300)
+        def get_tree(tree_name):
+    '''
+
+    def decorator(operation):
+        cache_name = name or get_response_cache_name(operation)
+
+        @functools.wraps(operation)
+        def wrapper(*args, **kwargs):
+            if flask.request.method not in ('GET', 'HEAD'):
+                return operation(*args, **kwargs)
+
+            key = get_response_cache_key(cache_name, kwargs, vary_on_user)
+            cached = cache.get(key)
+            if cached is None:
+                result = operation(*args, **kwargs)
+                body = result
+                if isinstance(result, tuple):
+                    if len(result) != 2 or result[1] != 200:
+                        return result
+                    body = result[0]
+                if isinstance(body, flask.Response):
+                    return result
+
+                data = flask.json.dumps(body).encode('utf-8')
+                cached = (data, hashlib.sha256(data).hexdigest())
+                cache.set(key, cached, timeout=timeout)
+
+            data, etag = cached
+            response = flask.current_app.response_class(data, mimetype='application/json')
+            response.set_etag(etag)
+            return response.make_conditional(flask.request)
+
+        wrapper.response_cache_name = cache_name
+        return wrapper
+
+    return decorator
+
+
+def invalidate_responses(*operations):
+    '''
+    Drop the cached responses of operations (decorated functions or names)
+    '''
+    for operation in operations:
+        name = get_response_cache_name(operation)
+        cache.set(f'{RESPONSE_KEY_PREFIX}generation:{name}', uuid.uuid4().hex, timeout=0)
+
+
+def invalidates_responses(*operations):
+    '''
+    Invalidate the cached responses of operations once the decorated (write)
+    operation succeeded
+    '''
+
+    def decorator(operation):
+
+        @functools.wraps(operation)
+        def wrapper(*args, **kwargs):
+            result = operation(*args, **kwargs)
+            invalidate_responses(*operations)
+            return result
+
+        return wrapper
+
+    return decorator
+
 
 def init_app(app):
     cache_config = app.config.get('CACHE', {'CACHE_TYPE': 'simple'})
     cache.init_app(app, config=cache_config)
+
+    if app.config.get('CACHE_INSTRUMENTATION', True):
+        app.extensions['cache'][cache] = InstrumentedCache(
+            app.extensions['cache'][cache],
+            max_prefixes=app.config.get('CACHE_INSTRUMENTATION_MAX_PREFIXES', 100),
+        )
+
     return cache
 
 
+def stats(app=None):
+    '''
+    Counters of the cache backend of an application, per key prefix
+    '''
+    if app is None:
+        app = flask.current_app
+    backend = app.extensions['cache'][cache]
+    if not isinstance(backend, InstrumentedCache):
+        return dict()
+    stats = {
+        backend.name: backend.stats(),
+    }
+    if isinstance(backend.backend, TieredCache):
+        stats['local'] = backend.backend.local.stats()
+    return stats
+
+
+def get_tiered_cache(app):
+    backend = app.extensions['cache'][cache]
+    if isinstance(backend, InstrumentedCache):
+        backend = backend.backend
+    if isinstance(backend, TieredCache):
+        return backend
+    return None
+
+
+def before_fork(app):
+    backend = get_tiered_cache(app)
+    if backend is not None:
+        backend.stop()
+
+
+def after_fork(app):
+    backend = get_tiered_cache(app)
+    if backend is not None:
+        backend.after_fork()
+
+
+def after_fork_parent(app):
+    backend = get_tiered_cache(app)
+    if backend is not None:
+        backend.listen()
+
+
 def app_heartbeat():
-    cache_key = str(uuid.uuid4().get_hex().upper()[0:6])
-    cache_value = str(uuid.uuid4().get_hex().upper()[0:6])
+    cache_key = HEARTBEAT_KEY_PREFIX + uuid.uuid4().hex
+    cache_value = uuid.uuid4().hex
     try:
         cache = flask.current_app.cache
         assert cache.cache.get(cache_key) is None
-        assert cache.cache.set(cache_key, cache_value) is True
+        # Expire the probe in case it cannot be deleted
+        assert cache.cache.set(cache_key, cache_value, timeout=60) is True
         assert cache.cache.get(cache_key) == cache_value
-        assert cache.cache.delete(cache_key) is True
-        assert cache.cache.get(cache_key)
+        # redis returns the number of deleted keys
+        assert cache.cache.delete(cache_key)
+        assert cache.cache.get(cache_key) is None
     except Exception as e:
         logger.exception(e)
         raise backend_common.dockerflow.HeartbeatException('Cannot get/set/delete items to the cache.')
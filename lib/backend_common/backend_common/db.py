@@ -3,23 +3,43 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
+import collections
+import datetime
+import decimal
+import hashlib
+import json
 import os
+import sys
+import threading
+import time
+import uuid
 
+import alembic.script
+import click
 import flask
 import flask_migrate
 import flask_sqlalchemy
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.event
+import sqlalchemy.exc
+import sqlalchemy.orm
+import sqlalchemy.pool
+import werkzeug.exceptions
 
 import backend_common.dockerflow
 import cli_common.log
+import cli_common.utils
 
 logger = cli_common.log.get_logger(__name__)
 db = flask_sqlalchemy.SQLAlchemy()
 migrate = flask_migrate.Migrate(db=db)
 
+# Column values of immutable unique objects, shared by every session
+unique_identities = cli_common.utils.TTLCache(maxsize=1024, ttl=3600)
 
-def _unique(session, cls, hashfunc, queryfunc, constructor, arg, kw, _test_hook=None):
-    # Based on
-    # https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/UniqueObject
+
+def _unique_cache(session):
     cache = session.info.get('_unique_cache', None)
     if cache is None:
         session.info['_unique_cache'] = cache = {}
@@ -30,9 +50,86 @@ def _unique(session, cls, hashfunc, queryfunc, constructor, arg, kw, _test_hook=
             if s.info.get('_unique_cache', None):
                 del s.info['_unique_cache']
 
+    return cache
+
+
+def _unique_pending(session):
+    '''
+    Unique objects to share with other sessions once their transaction is
+    committed, dropped if it is rolled back or closed
+    '''
+    return session.info.setdefault('_unique_pending', {})
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'before_commit')
+def _prepare_unique_identities(session):
+    if session.transaction.nested:
+        return
+    pending = session.info.pop('_unique_pending', {})
+    # Read the loaded state now: it is expired by the commit
+    prepared = session.info.setdefault('_unique_prepared', {})
+    for key, obj in pending.items():
+        state = db.inspect(obj)
+        values = {
+            prop.key: state.dict[prop.key]
+            for prop in state.mapper.column_attrs
+            if prop.key in state.dict
+        }
+        if state.key is not None and len(values) == len(state.mapper.column_attrs):
+            prepared[key] = values
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _share_unique_identities(session):
+    for key, values in session.info.pop('_unique_prepared', {}).items():
+        unique_identities.set(key, values)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _drop_unique_identities(session):
+    session.info.pop('_unique_pending', None)
+    session.info.pop('_unique_prepared', None)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_transaction_end')
+def _end_unique_identities(session, transaction):
+    # Closed without a commit
+    if transaction.parent is None:
+        _drop_unique_identities(session)
+
+
+def _unique_identity(session, key):
+    '''
+    Unique object shared by another session, merged without a query
+    '''
+    values = unique_identities.get(key)
+    if values is None:
+        return None
+    cls = key[0]
+    obj = db.inspect(cls).class_manager.new_instance()
+    for name, value in values.items():
+        setattr(obj, name, value)
+    db.make_transient_to_detached(obj)
+    return session.merge(obj, load=False)
+
+
+def clear_unique_identities(*args):
+    unique_identities.clear()
+
+
+def _unique(session, cls, hashfunc, queryfunc, constructor, arg, kw, _test_hook=None):
+    # Based on
+    # https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/UniqueObject
+    cache = _unique_cache(session)
+    shared = getattr(cls, 'unique_shared', False)
+
     key = (cls, hashfunc(*arg, **kw))
     if key in cache:
         return cache[key]
+    obj = _unique_identity(session, key) if shared else None
+    if obj is not None:
+        cache[key] = obj
+        return obj
     else:
         with session.no_autoflush:
             q = session.query(cls)
@@ -45,13 +142,122 @@ def _unique(session, cls, hashfunc, queryfunc, constructor, arg, kw, _test_hook=
                 session.add(obj)
                 session.flush()
         cache[key] = obj
+        if shared:
+            _unique_pending(session)[key] = obj
         return obj
 
 
+def _unique_query(session, cls, columns, values):
+    query = session.query(cls)
+    if len(columns) == 1:
+        return query.filter(columns[0].in_([value[0] for value in values]))
+    if session.get_bind(db.inspect(cls)).dialect.name == 'sqlite':
+        # No row values in IN clauses on sqlite
+        return query.filter(db.or_(*[
+            db.and_(*[column == item for column, item in zip(columns, value)])
+            for value in values
+        ]))
+    return query.filter(db.tuple_(*columns).in_(values))
+
+
+def _unique_row(mapper, columns, value, arg, kw):
+    '''
+    Column values inserted for constructor arguments: the unique values, and
+    keyword arguments of columns. None when other arguments are given, which
+    only the constructor knows how to apply (e.g. relationships).
+    '''
+    row = {column.property.columns[0].name: item for column, item in zip(columns, value)}
+    for name, item in kw.items():
+        prop = mapper.attrs.get(name)
+        if not isinstance(prop, sqlalchemy.orm.ColumnProperty):
+            return None
+        row[prop.columns[0].name] = item
+    if len(arg) > len(columns):
+        return None
+    return row
+
+
+def _unique_many(session, cls, arguments, batch_size=500):
+    cache = _unique_cache(session)
+    mapper = db.inspect(cls)
+    columns = cls.unique_columns()
+    dialect = session.get_bind(mapper).dialect.name
+
+    # Arguments are either positional arguments or keyword arguments
+    calls = [
+        ((), argument) if isinstance(argument, dict) else (tuple(argument), {})
+        for argument in arguments
+    ]
+    keys = [(cls, cls.unique_hash(*arg, **kw)) for arg, kw in calls]
+    shared = getattr(cls, 'unique_shared', False)
+
+    missing = collections.OrderedDict()
+    for key, (arg, kw) in zip(keys, calls):
+        if key in cache or key in missing:
+            continue
+        obj = _unique_identity(session, key) if shared else None
+        if obj is not None:
+            cache[key] = obj
+        else:
+            missing[key] = (tuple(cls.unique_values(*arg, **kw)), arg, kw)
+
+    with session.no_autoflush:
+        items = list(missing.items())
+        for start in range(0, len(items), batch_size):
+            # Keys of each unique value, several hashes may share one
+            values = collections.OrderedDict()
+            for key, (value, arg, kw) in items[start:start + batch_size]:
+                values.setdefault(value, []).append((key, arg, kw))
+
+            def load():
+                for obj in _unique_query(session, cls, columns, list(values.keys())):
+                    value = tuple(getattr(obj, column.key) for column in columns)
+                    for key, arg, kw in values.pop(value, []):
+                        cache[key] = obj
+
+            load()
+            if not values:
+                continue
+
+            # Insert every missing row at once, then load them
+            # (grouped by the columns they set), or through the session
+            groups = collections.OrderedDict()
+            constructed = False
+            for value, pending in values.items():
+                key, arg, kw = pending[0]
+                row = _unique_row(mapper, columns, value, arg, kw)
+                if row is None:
+                    session.add(cls(*arg, **kw))
+                    constructed = True
+                else:
+                    groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+            table = cls.__table__
+            for rows in groups.values():
+                if dialect == 'postgresql':
+                    insert = sqlalchemy.dialects.postgresql.insert(table).values(rows).on_conflict_do_nothing()
+                    session.execute(insert, mapper=mapper)
+                else:
+                    session.execute(table.insert(), rows, mapper=mapper)
+            if constructed:
+                session.flush()
+            load()
+            if values:
+                raise Exception(f'Could not create unique {cls.__name__} objects: {list(values.keys())}')
+
+    if shared:
+        _unique_pending(session).update((key, cache[key]) for key in missing.keys())
+
+    return [cache[key] for key in keys]
+
+
 class UniqueMixin(object):
     # Based on
     # https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/UniqueObject
 
+    # Share committed objects between sessions (see unique_identities):
+    # only for immutable objects, e.g. lookup tables
+    unique_shared = False
+
     @classmethod
     def unique_filter(cls, query, *arg, **kw):
         raise NotImplementedError()
@@ -60,6 +266,21 @@ class UniqueMixin(object):
     def unique_hash(cls, *arg, **kw):
         raise NotImplementedError()
 
+    @classmethod
+    def unique_columns(cls):
+        '''
+        Columns identifying an object, needed by as_unique_many
+        '''
+        raise NotImplementedError()
+
+    @classmethod
+    def unique_values(cls, *arg, **kw):
+        '''
+        Values of unique_columns for constructor arguments, needed by
+        as_unique_many
+        '''
+        raise NotImplementedError()
+
     @classmethod
     def as_unique(cls, session, *arg, **kw):
         return _unique(
@@ -71,34 +292,394 @@ class UniqueMixin(object):
             arg, kw
         )
 
+    @classmethod
+    def as_unique_many(cls, session, arguments, batch_size=500):
+        '''
+        Get or create the objects of many constructor arguments (tuples of
+        positional arguments, or dicts of keyword arguments) at once: existing
+        ones are loaded with an IN query, missing ones inserted with a single
+        statement (ON CONFLICT DO NOTHING on postgresql), per batch. Rows are
+        built from unique_values and column keyword arguments; objects with
+        other arguments are built by the constructor and flushed.
+        '''
+        return _unique_many(session, cls, arguments, batch_size)
 
-def init_database(app):
+
+# Flask configuration keys of the engine pool options
+POOL_OPTIONS = {
+    'DB_POOL_SIZE': 'pool_size',
+    'DB_POOL_MAX_OVERFLOW': 'max_overflow',
+    'DB_POOL_TIMEOUT': 'pool_timeout',
+    'DB_POOL_RECYCLE': 'pool_recycle',
+    'DB_POOL_PRE_PING': 'pool_pre_ping',
+}
+
+
+class PoolStats(object):
+    '''
+    Checkout latency and events of a connection pool
+    '''
+
+    def __init__(self):
+        self.checkout_latency = cli_common.utils.Histogram()
+        self.counters = collections.Counter()
+        self.max_checked_out = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self, pool):
+        with self._lock:
+            stats = dict(
+                self.counters,
+                max_checked_out=self.max_checked_out,
+            )
+        stats['checkout_latency'] = self.checkout_latency.stats()
+        stats['status'] = pool.status()
+        for name in ('size', 'checkedout', 'overflow', 'checkedin'):
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        return stats
+
+
+class InstrumentedPool(object):
+    '''
+    Pool mixin timing how long checkouts wait for a connection
+    '''
+
+    pool_stats = None
+
+    def _do_get(self):
+        stats = self.pool_stats
+        start = time.monotonic()
+        try:
+            connection_record = super(InstrumentedPool, self)._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            stats.incr('timeouts')
+            logger.warning('Database pool exhausted', status=self.status())
+            raise
+        finally:
+            stats.checkout_latency.observe(time.monotonic() - start)
+
+        if hasattr(self, 'checkedout'):
+            stats.max_checked_out = max(stats.max_checked_out, self.checkedout())
+        if hasattr(self, 'overflow') and self.overflow() > 0:
+            stats.incr('overflows')
+        return connection_record
+
+
+def instrument_pool(pool):
+    '''
+    Publish the metrics of a pool in its `pool_stats`, including the pools
+    it is recreated as (e.g. by engine.dispose)
+    '''
+    stats = PoolStats()
+    pool.__class__ = type(
+        f'Instrumented{type(pool).__name__}',
+        (InstrumentedPool, type(pool)),
+        dict(pool_stats=stats),
+    )
+
+    @db.event.listens_for(pool, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        stats.incr('connects')
+
+    @db.event.listens_for(pool, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.incr('checkouts')
+
+    @db.event.listens_for(pool, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        stats.incr('checkins')
+
+    @db.event.listens_for(pool, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        stats.incr('invalidations')
+
+    return stats
+
+
+def pool_stats(app=None):
+    '''
+    Metrics of the database pool of an application
+    '''
+    if app is None:
+        app = flask.current_app
+    pool = db.get_engine(app).pool
+    if not isinstance(pool, InstrumentedPool):
+        return dict()
+    return pool.pool_stats.stats(pool)
+
+
+def get_parameters_shape(parameters, executemany=False):
+    '''
+    Types of the parameters of a statement, without their (private) values
+    '''
+    if executemany:
+        if not parameters:
+            return []
+        return f'{len(parameters)} x {get_parameters_shape(parameters[0])}'
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def instrument_queries(app, engine):
+    '''
+    Count the queries of every request and their duration, log the slow ones
+
+    Statements slower than DB_SLOW_QUERY_THRESHOLD seconds are logged with
+    the shape of their parameters, requests issuing more than
+    DB_QUERY_COUNT_THRESHOLD queries (a sign of N+1 queries) are logged,
+    and in debug mode every response carries a Server-Timing header.
+    '''
+    slow_query_threshold = app.config.get('DB_SLOW_QUERY_THRESHOLD', 0.5)
+    query_count_threshold = app.config.get('DB_QUERY_COUNT_THRESHOLD', 50)
+
+    @db.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context._query_start = time.monotonic()
+
+    @db.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time.monotonic() - context._query_start
+        if flask.has_request_context():
+            count, total = flask.g.get('db_queries', (0, 0.0))
+            flask.g.db_queries = (count + 1, total + duration)
+        if duration >= slow_query_threshold:
+            logger.warning(
+                'Slow query',
+                duration=round(duration, 3),
+                statement=statement,
+                parameters=get_parameters_shape(parameters, executemany),
+            )
+
+    @app.after_request
+    def report_queries(response):
+        count, total = flask.g.get('db_queries', (0, 0.0))
+        if count > query_count_threshold:
+            logger.warning('Many queries', count=count, duration=round(total, 3), endpoint=flask.request.endpoint)
+        if app.debug:
+            response.headers.add('Server-Timing', f'db;dur={total * 1000:.1f};desc="{count} queries"')
+        return response
+
+
+def get_engine_options(app):
+    '''
+    Engine options from the DB_POOL_* configuration; pre-ping is enabled by
+    default and SQLALCHEMY_ENGINE_OPTIONS takes precedence
+    '''
+    options = dict(pool_pre_ping=True)
+    for key, option in POOL_OPTIONS.items():
+        if app.config.get(key) is not None:
+            options[option] = app.config[key]
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    return options
+
+
+Page = collections.namedtuple('Page', 'items next_cursor')
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        return {'$datetime': [
+            value.year, value.month, value.day,
+            value.hour, value.minute, value.second, value.microsecond,
+            offset.total_seconds() if offset is not None else None,
+        ]}
+    if isinstance(value, datetime.date):
+        return {'$date': value.toordinal()}
+    if isinstance(value, decimal.Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, uuid.UUID):
+        return {'$uuid': str(value)}
+    return value
+
+
+def _decode_cursor_value(value):
+    if not isinstance(value, dict):
+        return value
+    if '$datetime' in value:
+        *parts, offset = value['$datetime']
+        tzinfo = datetime.timezone(datetime.timedelta(seconds=offset)) if offset is not None else None
+        return datetime.datetime(*parts, tzinfo=tzinfo)
+    if '$date' in value:
+        return datetime.date.fromordinal(value['$date'])
+    if '$decimal' in value:
+        return decimal.Decimal(value['$decimal'])
+    if '$uuid' in value:
+        return uuid.UUID(value['$uuid'])
+    raise ValueError('Unknown cursor value')
+
+
+def _cursor_fingerprint(columns, descending):
+    ordering = ','.join(str(column) for column in columns) + (' desc' if descending else '')
+    return hashlib.sha1(ordering.encode('utf-8')).hexdigest()[:8]
+
+
+def encode_cursor(columns, values, descending=False):
+    '''
+    Opaque token of the position after a row, for an ordering
     '''
-    Run Migrations through Alembic
+    data = json.dumps([
+        _cursor_fingerprint(columns, descending),
+        [_encode_cursor_value(value) for value in values],
+    ], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(columns, cursor, descending=False):
     '''
-    migrations_dir = os.path.abspath(
+    Values of the row a cursor points after, raising a BadRequest when the
+    cursor is invalid or belongs to another ordering
+    '''
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        fingerprint, values = json.loads(data.decode('utf-8'))
+        if fingerprint != _cursor_fingerprint(columns, descending) or len(values) != len(columns):
+            raise ValueError('Cursor of another ordering')
+        return [_decode_cursor_value(value) for value in values]
+    except Exception as e:
+        logger.info('Invalid pagination cursor', cursor=cursor, error=str(e))
+        raise werkzeug.exceptions.BadRequest('Invalid pagination cursor.')
+
+
+def paginate(query, columns, cursor=None, limit=None, descending=False):
+    '''
+    Keyset (seek) pagination of a query
+
+    Rows are ordered by `columns`, which together must be unique (end with
+    the primary key), and the page starts after the row `cursor` (as
+    returned in the previous page) points to. Unlike OFFSET, the database
+    seeks straight to the page through the index on `columns`, however deep
+    it is. `cursor` and `limit` are meant to be the connexion parameters of
+    the operation; the limit defaults to DB_PAGINATION_LIMIT and is capped
+    by DB_PAGINATION_MAX_LIMIT.
+    '''
+    app = flask.current_app
+    if limit is None:
+        limit = app.config.get('DB_PAGINATION_LIMIT', 100)
+    limit = max(1, min(limit, app.config.get('DB_PAGINATION_MAX_LIMIT', 1000)))
+
+    if cursor:
+        keys = db.tuple_(*columns)
+        values = db.tuple_(*decode_cursor(columns, cursor, descending))
+        query = query.filter(keys < values if descending else keys > values)
+
+    rows = query.order_by(*[
+        column.desc() if descending else column.asc()
+        for column in columns
+    ]).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            columns,
+            [getattr(rows[-1], column.key) for column in columns],
+            descending,
+        )
+
+    return Page(rows, next_cursor)
+
+
+# A shared unique object may be deleted or changed despite being immutable
+db.event.listen(UniqueMixin, 'after_update', clear_unique_identities, propagate=True)
+db.event.listen(UniqueMixin, 'after_delete', clear_unique_identities, propagate=True)
+
+
+# Kept verbatim: this (unformatted) name is the one existing databases use
+VERSION_TABLE = '{app.import_name}_alembic_version'
+
+
+def get_migrations_dir(app):
+    return app.config.get('DB_MIGRATIONS_DIR') or os.path.abspath(
         os.path.join(app.root_path, '..', 'migrations'))
 
+
+def migrate_database(app, raise_errors=False):
+    '''
+    Run Migrations through Alembic, or create the full DB when the app has
+    no migrations. Failures are only logged unless raise_errors is set.
+    '''
+    migrations_dir = get_migrations_dir(app)
+    if os.path.isdir(migrations_dir):
+        logger.info('Starting migrations', app=app.name)
+        try:
+            flask_migrate.upgrade(directory=migrations_dir)
+            logger.info('Completed migrations', app=app.name)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error('Migrations failure', app=app.name, error=e)
+
+    else:
+        logger.info('No migrations: creating full DB', app=app.name)
+        db.create_all()
+
+
+def is_schema_at_head(app):
+    '''
+    Check the database is migrated to the heads of the migration scripts,
+    reading the version table only (no schema inspection)
+    '''
+    migrations_dir = get_migrations_dir(app)
+    if not os.path.isdir(migrations_dir):
+        return True
+
+    heads = set(alembic.script.ScriptDirectory(migrations_dir).get_heads())
+    query = db.select([db.column('version_num')]).select_from(db.table(VERSION_TABLE))
+    try:
+        with db.get_engine(app).connect() as connection:
+            versions = {row[0] for row in connection.execute(query)}
+    except sqlalchemy.exc.DBAPIError as e:
+        logger.warning('Cannot read the database version', app=app.name, error=str(e))
+        return False
+    return versions == heads
+
+
+def is_migrate_command():
+    '''
+    Check the application is loaded to run `flask migrate`
+    '''
+    if click.get_current_context(silent=True) is None:
+        return False
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('-')]
+    return arguments[:1] == ['migrate']
+
+
+def init_database(app):
+    '''
+    Setup migrations, and unless DB_MIGRATE_ON_STARTUP is false run them
+    (otherwise only check the schema is at head, see `flask migrate`)
+    '''
     with app.app_context():
 
         # Needed to init potential migrations later on
         # Use a separate alembic_version table per app
         options = {
-            f'version_table': '{app.import_name}_alembic_version',
+            'version_table': VERSION_TABLE,
         }
-        migrate.init_app(app, directory=migrations_dir, **options)
+        migrate.init_app(app, directory=get_migrations_dir(app), **options)
 
-        if os.path.isdir(migrations_dir):
-            logger.info('Starting migrations', app=app.name)
-            try:
-                flask_migrate.upgrade()
-                logger.info('Completed migrations', app=app.name)
-            except Exception as e:
-                logger.error('Migrations failure', app=app.name, error=e)
+        # `flask migrate` runs the migrations itself
+        if app.config.get('DB_MIGRATE_ON_STARTUP', True) and not is_migrate_command():
+            migrate_database(app)
+        elif app.config.get('DB_CHECK_SCHEMA_ON_STARTUP', True) and not is_schema_at_head(app):
+            logger.warning('Database schema is not at head, run migrations', app=app.name)
 
-        else:
-            logger.info('No migrations: creating full DB', app=app.name)
-            db.create_all()
+    @app.cli.command('migrate')
+    def migrate_command():
+        '''Run the database migrations'''
+        try:
+            migrate_database(app, raise_errors=True)
+        except Exception as e:
+            raise click.ClickException(f'Migrations failure: {e}')
 
 
 ALLOWED_TABLES = [
@@ -107,8 +688,19 @@ ALLOWED_TABLES = [
 
 
 def init_app(app):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app)
+    unique_identities.maxsize = app.config.get('DB_UNIQUE_CACHE_SIZE', 1024)
+    unique_identities.ttl = app.config.get('DB_UNIQUE_CACHE_TTL', 3600)
     db.init_app(app)
 
+    if app.config.get('DB_POOL_INSTRUMENTATION', True):
+        with app.app_context():
+            instrument_pool(db.get_engine(app).pool)
+
+    if app.config.get('DB_QUERY_INSTRUMENTATION', False):
+        with app.app_context():
+            instrument_queries(app, db.get_engine(app))
+
     # Try to run migrations on the app
     # or direct db creation
     init_database(app)
@@ -120,6 +712,30 @@ def init_app(app):
     return db
 
 
+def dispose_engine(app):
+    '''
+    Close the pooled connections of the database engine of an application,
+    new ones are opened on the next checkout
+    '''
+    with app.app_context():
+        db.session.remove()
+        engine = db.get_engine(app)
+        # The in-memory sqlite database lives in its single connection
+        if isinstance(engine.pool, sqlalchemy.pool.StaticPool):
+            return
+        engine.dispose()
+
+
+def before_fork(app):
+    dispose_engine(app)
+
+
+def after_fork(app):
+    # Connections inherited from the master are never reused by a worker
+    dispose_engine(app)
+    clear_unique_identities()
+
+
 def app_heartbeat():
     try:
         db = flask.current_app.db
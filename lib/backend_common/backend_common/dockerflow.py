@@ -8,17 +8,31 @@ Provide API endpoint for Dockerflow
 https://github.com/mozilla-services/Dockerflow
 '''
 
+import concurrent.futures
+import hashlib
 import importlib
 import json
+import os
+import threading
+import time
 
 import flask
 
 import backend_common
 import backend_common.dockerflow
+import backend_common.encoder
 import cli_common.log
 
 logger = cli_common.log.get_logger(__name__)
 
+VERSION_JSON_PATH = '/app/version.json'
+DEFAULT_VERSION = {
+    'source': 'https://github.com/mozilla-releng/services',
+    'version': 'unknown',
+    'commit': 'unknown',
+    'build': 'unknown'
+}
+
 
 class HeartbeatException(Exception):
     '''Error messages that are being collected from each extension which
@@ -30,21 +44,170 @@ class HeartbeatException(Exception):
         self.message = message
 
 
+class Heartbeat(object):
+    '''Checks of the services an application depends on.
+
+       The app_heartbeat callables of the extensions are resolved once (on
+       first use, not to import deferred extensions at startup), run
+       concurrently with a timeout each (HEARTBEAT_TIMEOUT, in seconds), and
+       their aggregated result is reused for HEARTBEAT_CACHE_TTL seconds.
+       A check still running (e.g. hanging) from a previous run is waited
+       for again rather than started once more, so the pool (one thread per
+       check) never grows.
+    '''
+
+    def __init__(self, app, extensions):
+        self.app = app
+        self.timeout = app.config.get('HEARTBEAT_TIMEOUT', 5)
+        self.cache_ttl = app.config.get('HEARTBEAT_CACHE_TTL', 10)
+        self.extensions = extensions
+        self._checks = None
+        self._lock = threading.Lock()
+        self._result = None
+        self._expires = 0
+        self._pool = None
+        self._running = dict()
+
+    @property
+    def checks(self):
+        if self._checks is None:
+            checks = dict()
+            for extension_name in self.extensions:
+                if extension_name not in backend_common.EXTENSIONS:
+                    continue
+                app_heartbeat = getattr(importlib.import_module('backend_common.' + extension_name), 'app_heartbeat', None)
+                if app_heartbeat is not None:
+                    checks[extension_name] = app_heartbeat
+            self._checks = checks
+        return self._checks
+
+    @checks.setter
+    def checks(self, checks):
+        self._checks = checks
+        self.after_fork()
+
+    def after_fork(self):
+        '''
+        Start from a new pool, e.g. in a forked process where the threads of
+        the parent do not run
+        '''
+        self._pool = None
+        self._running = dict()
+
+    def _run(self, extension_name, app_heartbeat):
+        logger.info(f'Testing heartbeat of {extension_name} extension')
+        with self.app.app_context():
+            start = time.monotonic()
+            try:
+                app_heartbeat()
+                message = None
+            except HeartbeatException as e:
+                message = e.message
+            except Exception as e:
+                logger.exception(e)
+                message = f'Heartbeat of {extension_name} extension failed.'
+            return message, time.monotonic() - start
+
+    def run(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(self.checks), 1),
+                thread_name_prefix='heartbeat',
+            )
+        futures = dict()
+        for extension_name, app_heartbeat in self.checks.items():
+            future = self._running.get(extension_name)
+            if future is None or future.done():
+                future = self._running[extension_name] = self._pool.submit(self._run, extension_name, app_heartbeat)
+            futures[extension_name] = future
+        deadline = time.monotonic() + self.timeout
+        checks = dict()
+        for extension_name, future in futures.items():
+            try:
+                message, latency = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except concurrent.futures.TimeoutError:
+                message, latency = f'Heartbeat timed out after {self.timeout}s.', self.timeout
+            checks[extension_name] = dict(
+                status=message is None and 'ok' or 'error',
+                latency=round(latency, 6),
+            )
+            if message is not None:
+                checks[extension_name]['message'] = message
+        return dict(
+            status=all(check['status'] == 'ok' for check in checks.values()) and 'ok' or 'error',
+            checks=checks,
+        )
+
+    def check(self):
+        with self._lock:
+            if self._result is None or time.monotonic() >= self._expires:
+                self._result = self.run()
+                self._expires = time.monotonic() + self.cache_ttl
+            return self._result
+
+
+class Version(object):
+    '''The version document of the application.
+
+       It is loaded and validated once, then served pre-serialised with an
+       ETag. With `reload`, the document is loaded again when the file
+       modification time changes.
+    '''
+
+    def __init__(self, path=VERSION_JSON_PATH, reload=False):
+        self.path = path
+        self.reload = reload
+        self._lock = threading.Lock()
+        self.load()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        mtime = self._mtime()
+        version_json = dict(DEFAULT_VERSION)
+        if mtime is not None:
+            try:
+                with open(self.path) as f:
+                    document = json.load(f)
+                if not isinstance(document, dict):
+                    raise ValueError('version document should be an object')
+                missing = [key for key in DEFAULT_VERSION if key not in document]
+                if missing:
+                    logger.warning('Incomplete version document', path=self.path, missing=missing)
+                version_json.update(document)
+            except (OSError, ValueError) as e:
+                logger.error('Invalid version document', path=self.path, error=str(e))
+
+        self.body = json.dumps(version_json, sort_keys=True).encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.mtime = mtime
+
+    def response(self):
+        if self.reload and self._mtime() != self.mtime:
+            with self._lock:
+                if self._mtime() != self.mtime:
+                    self.load()
+
+        response = flask.Response(
+            self.body,
+            headers={
+                'Content-Type': 'application/json',
+                'Cache-Control': 'public, max-age=60',
+            },
+        )
+        response.set_etag(self.etag)
+        return response.make_conditional(flask.request)
+
+
 def get_version():
-    version_json = {
-        'source': 'https://github.com/mozilla-releng/services',
-        'version': 'unknown',
-        'commit': 'unknown',
-        'build': 'unknown'
-    }
-    try:
-        version_json_path = '/app/version.json'
-        with open(version_json_path) as f:
-            version_json = json.load(f)
-    except Exception:
-        pass
-
-    return flask.jsonify(version_json)
+    version = getattr(flask.current_app, 'version', None)
+    if version is None:
+        version = flask.current_app.version = Version()
+    return version.response()
 
 
 def lbheartbeat_response():
@@ -58,32 +221,10 @@ def heartbeat_response():
     '''Per the Dockerflow spec:
     Respond to /__heartbeat__ with a HTTP 200 or 5xx on error. This should
     depend on services like the database to also ensure they are healthy.'''
-    response = dict()
-    extensions = flask.current_app.__extensions
-
-    for extension_name in extensions:
-        if extension_name not in backend_common.EXTENSIONS:
-            continue
-
-        extension_heartbeat = None
-        try:
-            app_heartbeat = getattr(importlib.import_module('backend_common.' + extension_name), 'app_heartbeat')
-            logger.info(f'Testing heartbeat of {extension_name} extension')
-            app_heartbeat()
-        except HeartbeatException as e:
-            extension_heartbeat = e.message
-
-        if extension_heartbeat is None:
-            continue
-
-        response[extension_name] = extension_heartbeat
-
-    if len(response) == 0:
-        return flask.Response('OK', headers={'Cache-Control': 'public, max-age=60'})
-    else:
-        return flask.Response(status=502,
-                              response=json.dumps(response),
-                              headers={
-                                  'Content-Type': 'application/json',
-                                  'Cache-Control': 'public, max-age=60',
-                              })
+    response = flask.current_app.heartbeat.check()
+    return flask.Response(status=response['status'] == 'ok' and 200 or 502,
+                          response=backend_common.encoder.dumps(response),
+                          headers={
+                              'Content-Type': 'application/json',
+                              'Cache-Control': 'public, max-age=60',
+                          })
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+JSON encoding of API responses, using orjson or ujson when installed
+
+Every backend produces the same documents as connexion's FlaskJSONEncoder
+(naive datetimes are assumed to be UTC, decimals are numbers, and Flask
+encodes UUIDs and dataclasses). Optimised backends do not escape non-ASCII
+characters. Whatever they cannot encode (e.g. with skipkeys, an indent
+other than 2, integers larger than 64 bits, NaN or infinities) is encoded
+by the standard library.
+'''
+
+import datetime
+import decimal
+import functools
+import math
+import uuid
+
+import flask.json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def orjson_dumps(obj, default, sort_keys=False, indent=None):
+    # Datetimes go through `default` to keep the connexion format
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+
+
+def ujson_dumps(obj, default, sort_keys=False, indent=None):
+    return ujson.dumps(
+        obj,
+        default=default,
+        sort_keys=sort_keys,
+        indent=indent or 0,
+        ensure_ascii=False,
+        escape_forward_slashes=False,
+    )
+
+
+BACKENDS = {
+    'orjson': orjson is not None and orjson_dumps or None,
+    'ujson': ujson is not None and ujson_dumps or None,
+    'json': None,
+}
+
+
+def has_non_finite_numbers(obj):
+    '''
+    Check a document for NaN or infinities, which orjson encodes as null
+    '''
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, float):
+            if not math.isfinite(obj):
+                return True
+        elif isinstance(obj, decimal.Decimal):
+            if not obj.is_finite():
+                return True
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return False
+
+
+def get_backend(name='auto'):
+    '''
+    Name of the encoding backend to use: the requested one when installed,
+    with `auto` the fastest installed, and `json` (standard library) otherwise
+    '''
+    if name == 'auto':
+        for name in ('orjson', 'ujson'):
+            if BACKENDS[name] is not None:
+                return name
+        return 'json'
+    if name not in BACKENDS:
+        raise Exception(f'Unknown JSON encoder: {name}')
+    if BACKENDS[name] is None:
+        return 'json'
+    return name
+
+
+class JSONEncoder(flask.json.JSONEncoder):
+    '''
+    JSON encoder of API responses, using an optimised backend when possible
+    '''
+
+    backend = get_backend()
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            if o.tzinfo:
+                return o.isoformat('T')
+            # No timezone present - assume UTC
+            return o.isoformat('T') + 'Z'
+        if isinstance(o, (datetime.date, datetime.time)):
+            return o.isoformat()
+        if isinstance(o, decimal.Decimal):
+            return float(o)
+        if isinstance(o, uuid.UUID):
+            return str(o)
+        return super(JSONEncoder, self).default(o)
+
+    def encode(self, o):
+        dumps = BACKENDS[self.backend]
+        if dumps is None or self.skipkeys or self.indent not in (None, 2):
+            return super(JSONEncoder, self).encode(o)
+        try:
+            encoded = dumps(o, self.default, sort_keys=self.sort_keys, indent=self.indent)
+        except (TypeError, ValueError, OverflowError):
+            return super(JSONEncoder, self).encode(o)
+        if 'null' in encoded and has_non_finite_numbers(o):
+            return super(JSONEncoder, self).encode(o)
+        return encoded
+
+
+@functools.lru_cache()
+def get_json_encoder(backend='auto'):
+    return type('JSONEncoder', (JSONEncoder, ), dict(backend=get_backend(backend)))
+
+
+def dumps(obj, backend='auto', **kwargs):
+    '''
+    Encode an object, like json.dumps
+    '''
+    return get_json_encoder(backend)(**kwargs).encode(obj)
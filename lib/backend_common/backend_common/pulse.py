@@ -33,6 +33,12 @@ class Pulse(object):
             connect_timeout=connect_timeout,
         )
 
+    def reset(self):
+        '''
+        Replace the connection by a new (not yet established) one
+        '''
+        self.connection = self.connection.clone()
+
     def ping(self):
         with self.connection as connection:
             if connection.connected:
@@ -78,6 +84,14 @@ def init_app(app):
     )
 
 
+def before_fork(app):
+    app.pulse.connection.release()
+
+
+def after_fork(app):
+    app.pulse.reset()
+
+
 def app_heartbeat():
     try:
         flask.current_app.pulse.ping()
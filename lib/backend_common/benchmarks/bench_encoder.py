@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Compare the JSON encoding backends of backend_common.encoder
+
+Usage: python benchmarks/bench_encoder.py [number of items]
+'''
+
+import datetime
+import decimal
+import sys
+import timeit
+import uuid
+
+import connexion.apps.flask_app
+
+import backend_common.encoder
+
+
+def build_payloads(size):
+    now = datetime.datetime(2018, 1, 2, 3, 4, 5)
+    return [
+        ('small object', dict(status='ok', user_id='user@mozilla.com', permissions=[f'project:releng:services/api/{i}' for i in range(10)])),
+        ('list of objects', [
+            dict(id=i, name=f'tree{i}', status='open', reason='', message_of_the_day='Check the wiki', tags=['a', 'b'])
+            for i in range(size)
+        ]),
+        ('datetimes and decimals', [
+            dict(id=str(uuid.uuid4()), when=now + datetime.timedelta(seconds=i), price=decimal.Decimal(i) / 100)
+            for i in range(size)
+        ]),
+        ('nested documents', dict(
+            (f'product{i}', dict(versions=[dict(version=f'{i}.{j}', builds=list(range(5))) for j in range(10)]))
+            for i in range(size // 10)
+        )),
+    ]
+
+
+def main(size=1000, number=100):
+    encoders = [('connexion FlaskJSONEncoder', connexion.apps.flask_app.FlaskJSONEncoder)] + [
+        (name, backend_common.encoder.get_json_encoder(name))
+        for name, dumps in backend_common.encoder.BACKENDS.items()
+        if name == 'json' or dumps is not None
+    ]
+
+    print(f'{size} items, {number} encodings')
+    for payload_name, payload in build_payloads(size):
+        print(payload_name)
+        for name, encoder in encoders:
+            duration = min(timeit.repeat(lambda: encoder(sort_keys=True).encode(payload), number=number, repeat=3))
+            print(f'{name:>28}: {duration / number * 1e6:10.2f} us per encoding')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Measure the per-request cost of connexion response validation
+
+Usage: python benchmarks/bench_response_validation.py [number of items]
+'''
+
+import os
+import sys
+import tempfile
+import timeit
+
+import connexion.resolver
+
+import backend_common
+import backend_common.testing
+
+SPECIFICATION = '''
+---
+swagger: "2.0"
+info:
+  version: "1.0.0"
+  title: "Benchmark"
+produces:
+  - application/json
+paths:
+  /items:
+    get:
+      operationId: list_items
+      responses:
+        200:
+          description: Items
+          schema:
+            type: array
+            items:
+              $ref: '#/definitions/Item'
+definitions:
+  Item:
+    type: object
+    required:
+      - id
+      - name
+      - tags
+    properties:
+      id:
+        type: integer
+      name:
+        type: string
+      status:
+        type: string
+        enum: [open, closed, approval required]
+      tags:
+        type: array
+        items:
+          type: string
+'''
+
+
+def build_app(specification, items, rate):
+    app = backend_common.create_app(
+        app_name='bench',
+        project_name='Benchmark',
+        extensions=['api'],
+        config=backend_common.testing.get_app_config({}),
+    )
+    app.api.register(
+        specification,
+        resolver=connexion.resolver.Resolver(lambda operation_id: lambda: items),
+        response_validation_rate=rate,
+    )
+    return app
+
+
+def main(size=1000, number=200):
+    items = [
+        dict(id=i, name=f'item{i}', status='open', tags=['a', 'b', 'c'])
+        for i in range(size)
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        specification = os.path.join(tmpdir, 'api.yml')
+        with open(specification, 'w') as f:
+            f.write(SPECIFICATION)
+
+        print(f'{size} items per response, {number} requests')
+        baseline = None
+        for rate in (0, 0.01, 0.1, 1):
+            client = build_app(specification, items, rate).test_client()
+            assert client.get('/items').status_code == 200
+            duration = min(timeit.repeat(lambda: client.get('/items'), number=number, repeat=3)) / number
+            if baseline is None:
+                baseline = duration
+            print(f'validation rate {rate:>4}: {duration * 1e3:8.2f} ms per request (+{(duration - baseline) * 1e3:.2f} ms)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Compare taskcluster.utils.scopeMatch with backend_common.auth.TaskclusterScopes
+
+Usage: python benchmarks/bench_scopes.py [number of assumed scopes]
+'''
+
+import sys
+import timeit
+
+import taskcluster.utils
+
+import backend_common.auth
+
+
+def build_scopes(size):
+    scopes = []
+    for i in range(size):
+        if i % 10 == 0:
+            scopes.append(f'project:releng:services/project{i}/*')
+        else:
+            scopes.append(f'project:releng:services/project{i}/api/resource{i}')
+    return scopes
+
+
+def main(size=500, number=2000):
+    scopes = build_scopes(size)
+    required = [
+        ['project:releng:services/unknown/api/read', 'project:releng:services/unknown/api/write'],
+        [f'project:releng:services/project{size - 10}/api/write', f'project:releng:services/project{size - 1}/api/resource{size - 1}'],
+    ]
+    assert taskcluster.utils.scopeMatch(scopes, required) is True
+
+    compiled = backend_common.auth.TaskclusterScopes(scopes)
+    credentials = dict(clientId='bench/user@mozilla.com', scopes=scopes)
+    assert compiled.match(required) is True
+
+    results = [
+        ('scopeMatch', lambda: taskcluster.utils.scopeMatch(scopes, required)),
+        ('TaskclusterScopes.match', lambda: compiled.match(required)),
+        ('TaskclusterScopes (build + match)', lambda: backend_common.auth.TaskclusterScopes(scopes).match(required)),
+        ('TaskclusterUser.has_permissions', lambda: backend_common.auth.TaskclusterUser(credentials).has_permissions(required)),
+    ]
+    print(f'{size} assumed scopes, {number} checks')
+    for name, func in results:
+        duration = min(timeit.repeat(func, number=number, repeat=3))
+        print(f'{name:>34}: {duration / number * 1e6:8.2f} us per check')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
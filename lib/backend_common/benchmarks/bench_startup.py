@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Measure the cold start of backend_common.create_app, with and without
+deferred extensions, each run in a fresh interpreter
+
+Usage: python benchmarks/bench_startup.py [number of runs]
+'''
+
+import json
+import subprocess
+import sys
+
+SCRIPT = '''
+import json
+import time
+start = time.monotonic()
+import backend_common
+import backend_common.testing
+app = backend_common.create_app(
+    app_name='bench',
+    project_name='Benchmark',
+    extensions=['log', 'api', 'cache', 'pulse', 'aws'],
+    config=backend_common.testing.get_app_config(dict(DEFERRED_EXTENSIONS={deferred!r})),
+    redirect_root_to_api=False,
+)
+print(json.dumps(dict(total=time.monotonic() - start, profile=app.startup_profile)))
+'''
+
+
+def run(deferred):
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(deferred=deferred)],
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(number=5):
+    for name, deferred in (('eager', []), ('deferred pulse, aws', ['pulse', 'aws'])):
+        results = [run(deferred) for _ in range(number)]
+        best = min(results, key=lambda result: result['total'])
+        print(f'{name:>20}: {best["total"] * 1e3:8.1f} ms (best of {number})')
+        for extension_name, profile in best['profile'].items():
+            if extension_name != 'total':
+                print(f'{extension_name:>28}: import {profile["import_time"] * 1e3:7.1f} ms, init {profile["init_time"] * 1e3:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
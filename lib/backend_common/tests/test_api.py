@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import flask
+import pytest
+
+
+@pytest.mark.parametrize('config, rate', [
+    ({'TESTING': True, 'APP_CHANNEL': 'production'}, 1.0),
+    ({'APP_CHANNEL': 'production'}, 0.01),
+    ({'APP_CHANNEL': 'staging'}, 1.0),
+    ({'APP_CHANNEL': 'production', 'API_RESPONSE_VALIDATION_RATE': 0.5}, 0.5),
+])
+def test_response_validation_rate(config, rate):
+    '''
+    Test the share of validated responses depends on the channel
+    '''
+    import backend_common.api
+
+    app = flask.Flask('test_response_validation_rate')
+    app.config.update(config)
+    assert backend_common.api.get_response_validation_rate(app) == rate
+
+
+def test_sampled_response_validator(monkeypatch):
+    '''
+    Test only a sample of the responses is validated
+    '''
+    import random
+    import backend_common.api
+
+    validated = []
+
+    def validate_response(self, data, status_code, headers, url):
+        validated.append(data)
+
+    def function(request):
+        return request
+
+    class Api(object):
+        def get_connexion_response(self, response, mimetype):
+            return type('Response', (), dict(body=response, status_code=200, headers={}))
+
+    class Operation(object):
+        api = Api()
+
+    monkeypatch.setattr(backend_common.api.SampledResponseValidator, 'validate_response', validate_response)
+    request = type('Request', (), dict(url='/'))
+
+    assert backend_common.api.get_response_validator(0)(Operation(), 'application/json')(function) is function
+
+    wrapper = backend_common.api.get_response_validator(0.5)(Operation(), 'application/json')(function)
+    monkeypatch.setattr(random, 'random', lambda: 0.7)
+    assert wrapper(request) is request
+    assert validated == []
+    monkeypatch.setattr(random, 'random', lambda: 0.2)
+    assert wrapper(request) is request
+    assert validated == [request]
+
+
+def test_stream_json(monkeypatch):
+    '''
+    Test collections are streamed in chunks, as JSON or NDJSON
+    '''
+    import json
+    import backend_common.api
+    import backend_common.encoder
+
+    app = flask.Flask('test_stream_json')
+    app.json_encoder = backend_common.encoder.get_json_encoder()
+    consumed = []
+
+    def items():
+        for i in range(100):
+            consumed.append(i)
+            yield dict(id=i)
+
+    @app.route('/items')
+    def list_items():
+        return backend_common.api.stream_json(items(), serialize=lambda item: dict(item, double=item['id'] * 2), chunk_size=100)
+
+    client = app.test_client()
+    resp = client.get('/items', buffered=False)
+    assert resp.is_streamed
+    assert resp.mimetype == 'application/json'
+    chunks = iter(resp.response)
+    first = next(chunks)
+    assert first.startswith(b'[{')
+    assert len(consumed) < 100
+    assert json.loads(first + b''.join(chunks)) == [
+        dict(id=i, double=i * 2)
+        for i in range(100)
+    ]
+
+    resp = client.get('/items', headers=[('Accept', 'application/x-ndjson')])
+    assert resp.mimetype == 'application/x-ndjson'
+    lines = resp.data.decode('utf-8').splitlines()
+    assert [json.loads(line)['id'] for line in lines] == list(range(100))
+
+    # Streamed responses are not validated
+    validated = []
+    monkeypatch.setattr(backend_common.api.SampledResponseValidator, 'validate_response', lambda self, *args: validated.append(args))
+    validator = backend_common.api.get_response_validator(1)(None, 'application/json')
+    with app.test_request_context('/items'):
+        response = validator(lambda request: list_items())(flask.request)
+    assert response.is_streamed
+    assert validated == []
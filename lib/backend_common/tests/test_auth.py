@@ -51,6 +51,34 @@ def test_taskcluster_user():
         user = backend_common.auth.TaskclusterUser({'clientId': '', 'scopes': None})
 
 
+@pytest.mark.parametrize('scopes, required', [
+    ([], [[]]),
+    ([], [['project/test/A']]),
+    (['project/test/A'], []),
+    (['project/test/A'], [['project/test/A']]),
+    (['project/test/A'], [['project/test/AB']]),
+    (['project/test/A*'], [['project/test/AB']]),
+    (['project/test/*'], [['project/test/A', 'project/test/B']]),
+    (['project/test/*'], [['project/test*']]),
+    (['project/test/A', 'project/test/C'], [['project/test/A', 'project/test/B']]),
+    (['project/test/A', 'project/test-admin/*'], [['project/test/A', 'project/test/B'], ['project/test-admin/x']]),
+    (['*'], [['anything']]),
+])
+def test_taskcluster_scopes(scopes, required):
+    '''
+    Test the scopes index matches like Taskcluster
+    '''
+    import taskcluster.utils
+    import backend_common.auth
+
+    expected = taskcluster.utils.scopeMatch(scopes, required)
+    assert backend_common.auth.TaskclusterScopes(scopes).match(required) is expected
+
+    user = backend_common.auth.TaskclusterUser({'clientId': 'test/user@mozilla.com', 'scopes': scopes})
+    if required:
+        assert user.has_permissions(required) is expected
+
+
 def test_auth(client):
     '''
     Test the Taskcluster authentication
@@ -134,3 +162,309 @@ def test_scopes_admin(client):
     resp = client.get('/test-auth-scopes', headers=[('Authorization', header)])
     assert resp.status_code == 200
     assert resp.data == b'Your scopes are ok.'
+
+
+def test_taskcluster_hawk_validation(client, monkeypatch):
+    '''
+    Test every Hawk header is validated by Taskcluster, even when replayed,
+    with a service client built once per set of credentials
+    '''
+
+    import backend_common.auth
+    import backend_common.testing
+
+    calls = []
+    services = []
+
+    class FakeAuthService(object):
+        def authenticateHawk(self, payload):
+            calls.append(payload)
+            client_id, ext_data = backend_common.testing.parse_header(payload['authorization'])
+            if len(calls) > 1 and calls[-2]['authorization'] == payload['authorization']:
+                return {'status': 'auth-failed'}
+            return {
+                'status': 'auth-success',
+                'clientId': client_id,
+                'scopes': ext_data['scopes'],
+                'expires': '2100-01-01T00:00:00.000Z',
+            }
+
+    def get_service(service_name, client_id=None, access_token=None):
+        services.append((service_name, client_id, access_token))
+        return FakeAuthService()
+
+    monkeypatch.setattr(backend_common.auth.cli_common.taskcluster, 'get_service', get_service)
+    backend_common.auth.get_taskcluster_service.cache_clear()
+
+    header = backend_common.testing.build_header('test/user@mozilla.com', {'scopes': ['project/test/*']})
+    resp = client.get('/test-auth-login', headers=[('Authorization', header)])
+    assert resp.status_code == 200
+
+    # A replayed header is not served from a cache
+    resp = client.get('/test-auth-login', headers=[('Authorization', header)])
+    assert resp.status_code == 401
+    assert len(calls) == 2
+
+    header = backend_common.testing.build_header('test/user@mozilla.com', {'scopes': ['project/test/*']})
+    resp = client.get('/test-auth-login', headers=[('Authorization', header)])
+    assert resp.status_code == 200
+    assert len(calls) == 3
+    assert services == [('auth', 'XXX', 'YYY')]
+    backend_common.auth.get_taskcluster_service.cache_clear()
+
+
+def test_auth0_cache(app, client, monkeypatch):
+    '''
+    Test Auth0 userinfo lookups are cached per process and in the shared cache
+    '''
+
+    import re
+    import responses
+    import backend_common.auth
+    import backend_common.testing
+
+    calls = []
+
+    def userinfo(request):
+        calls.append(request)
+        return backend_common.testing.mock_auth_auth0(request)
+
+    backend_common.testing.requests_mock.add_callback(
+        responses.GET,
+        re.compile(r'https://auth\.localhost/userinfo.*'),
+        callback=userinfo,
+    )
+    monkeypatch.setattr(backend_common.auth.auth0, 'client_secrets', {}, raising=False)
+    monkeypatch.setitem(app.config, 'AUTH0_AUTH_CACHE_SHARED', True)
+    cache = backend_common.auth.auth.auth0_cache
+    cache.clear()
+
+    assert backend_common.auth.get_auth0_userinfo('badtoken') is None
+    assert len(calls) == 1
+
+    for _ in range(2):
+        userinfo = backend_common.auth.get_auth0_userinfo('goodtoken')
+        assert userinfo['email'] == backend_common.testing.AUTH0_DUMMY_USERINFO['email']
+    assert len(calls) == 2
+
+    # Another worker finds the userinfo in the shared cache
+    cache.clear()
+    assert backend_common.auth.get_auth0_userinfo('goodtoken') is not None
+    assert len(calls) == 2
+
+
+def test_auth0_user(app, monkeypatch):
+    '''
+    Test Auth0User permissions are read from the AUTH0_AUTH_SCOPES index
+    '''
+    import backend_common.auth
+    import backend_common.testing
+
+    userinfo = backend_common.testing.AUTH0_DUMMY_USERINFO
+    user = backend_common.auth.Auth0User('token', userinfo)
+
+    monkeypatch.setitem(app.config, 'AUTH0_AUTH_SCOPES', {
+        'project/test/A': [userinfo['email'], 'someone@mozilla.com'],
+        'project/test/B': ['someone@mozilla.com'],
+    })
+    assert user.get_permissions() == {'project/test/A'}
+    assert user.has_permissions('project/test/A')
+    assert not user.has_permissions(['project/test/A', 'project/test/B'])
+
+    # Replacing the configuration rebuilds the index
+    monkeypatch.setitem(app.config, 'AUTH0_AUTH_SCOPES', {
+        'project/test/B': [userinfo['email']],
+    })
+    assert user.get_permissions() == {'project/test/B'}
+
+
+def test_relengapi_token_cache(app):
+    '''
+    Test relengapi tokens are cached until they are updated or revoked
+    '''
+    import backend_common.auth
+
+    cache = backend_common.auth.auth.relengapi_cache
+    cache.clear()
+
+    token = backend_common.auth.RelengapiToken(
+        typ='usr',
+        description='Test token',
+        user='lmoran@mozilla.com',
+        disabled=False,
+        permissions=['tooltool.download.public', 'base.tokens.usr.view.my'],
+    )
+    app.db.session.add(token)
+    app.db.session.commit()
+    token_id = token.id
+
+    token_data = backend_common.auth.get_relengapi_token(token_id)
+    assert token_data.disabled is False
+    assert token_data.permissions == (
+        'project:releng:services/tooltool/api/download/public',
+        'project:releng:services/tokens/api/usr/view/my',
+    )
+    assert backend_common.auth.get_relengapi_token(token_id) is token_data
+
+    # Updated through another worker
+    app.cache.delete(f'{backend_common.auth.RELENGAPI_TOKEN_VERSION_CACHE_PREFIX}{token_id}')
+    assert backend_common.auth.get_relengapi_token(token_id) is not token_data
+    assert backend_common.auth.get_relengapi_token(token_id) == token_data
+
+    # Revoking the token invalidates the cache
+    token.disabled = True
+    app.db.session.commit()
+    assert backend_common.auth.get_relengapi_token(token_id).disabled is True
+
+    app.db.session.delete(token)
+    app.db.session.commit()
+    assert backend_common.auth.get_relengapi_token(token_id) is None
+
+
+def test_relengapi_permissions(app):
+    '''
+    Test relengapi permissions translation and initial data
+    '''
+    import flask_login
+    import backend_common.auth
+
+    assert backend_common.auth.from_relengapi_permission('tooltool.upload.public') == \
+        'project:releng:services/tooltool/api/upload/public'
+    assert backend_common.auth.to_relengapi_permission('project:releng:services/tooltool/api/upload/public') == \
+        'tooltool.upload.public'
+    assert backend_common.auth.from_relengapi_permission('mapper.mapping.unknown') == \
+        'project:releng:services/mapper/api/mapping/unknown'
+    assert backend_common.auth.to_relengapi_permission('project:releng:services/mapper/api/mapping/unknown') == \
+        'mapper.mapping.unknown'
+    assert backend_common.auth.from_relengapi_permission('project:other') == 'project:other'
+
+    user = backend_common.auth.TaskclusterUser({
+        'clientId': 'test/user@mozilla.com',
+        'scopes': [
+            'project:releng:services/tooltool/api/download/*',
+            'project:releng:services/mapper/api/project/insert',
+        ],
+    })
+    with app.test_request_context():
+        flask_login.login_user(user)
+        data = backend_common.auth.initial_data()
+
+    assert data['user']['type'] == 'taskcluster'
+    assert [p['name'] for p in data['user']['permissions']] == [
+        'mapper.project.insert',
+        'tooltool.download.internal',
+        'tooltool.download.public',
+    ]
+
+
+def test_authentication_dispatch(app, client, monkeypatch):
+    '''
+    Test credentials are routed to a single backend and rejections are cached
+    '''
+    import itsdangerous
+    import re
+    import responses
+    import backend_common.auth
+    import backend_common.testing
+
+    loads = []
+
+    class Serializer(itsdangerous.JSONWebSignatureSerializer):
+        def loads(self, *args, **kwargs):
+            loads.append(args[0])
+            return super(Serializer, self).loads(*args, **kwargs)
+
+    serializer = Serializer('secret')
+    relengapi_token = serializer.dumps({'iss': 'ra2', 'typ': 'prm', 'jti': 't1'}).decode('utf-8')
+    # HMAC signed Auth0 access tokens are not relengapi tokens
+    auth0_token = itsdangerous.JSONWebSignatureSerializer('auth0').dumps({'iss': 'https://auth.localhost/'}).decode('utf-8')
+    other_token = serializer.dumps({'iss': 'https://auth.localhost/'}).decode('utf-8')
+    monkeypatch.setattr(app, 'auth_relengapi_serializer', serializer, raising=False)
+    with app.app_context():
+        assert backend_common.auth.is_relengapi_token(relengapi_token)
+        assert not backend_common.auth.is_relengapi_token(auth0_token)
+        assert not backend_common.auth.is_relengapi_token(other_token)
+        assert not backend_common.auth.is_relengapi_token('abcdefghijklmnopqrstuvwxyz123456')
+        assert not backend_common.auth.is_relengapi_token('not.a.jws')
+
+    calls = []
+
+    def userinfo(request):
+        calls.append(request)
+        if 'unavailable' in request.url:
+            return (503, {}, 'Service Unavailable')
+        return backend_common.testing.mock_auth_auth0(request)
+
+    backend_common.testing.requests_mock.add_callback(
+        responses.GET,
+        re.compile(r'https://dispatch\.localhost/userinfo.*'),
+        callback=userinfo,
+    )
+    monkeypatch.setattr(
+        backend_common.auth.auth0, 'client_secrets', {'userinfo_uri': 'https://dispatch.localhost/userinfo'}, raising=False)
+    monkeypatch.setitem(app.config, 'AUTH0_AUTH', True)
+    monkeypatch.setitem(app.config, 'RELENGAPI_AUTH', True)
+    backend_common.auth.auth.negative_cache.clear()
+
+    # A relengapi token never reaches Auth0, and is decoded once
+    loads.clear()
+    resp = client.get('/test-auth-login', headers=[('Authorization', f'Bearer {relengapi_token}')])
+    assert resp.status_code == 401
+    assert len(calls) == 0
+    assert loads == [relengapi_token]
+
+    # An HMAC signed Auth0 token is validated by Auth0
+    resp = client.get('/test-auth-login', headers=[('Authorization', f'Bearer {auth0_token}')])
+    assert len(calls) == 1
+
+    # A rejected Auth0 token is only checked once
+    for _ in range(3):
+        resp = client.get('/test-auth-login', headers=[('Authorization', 'Bearer badtoken')])
+        assert resp.status_code == 401
+    assert len(calls) == 2
+
+    # An unavailable Auth0 does not reject the token
+    for _ in range(3):
+        resp = client.get('/test-auth-login', headers=[('Authorization', 'Bearer unavailable')])
+        assert resp.status_code == 401
+    assert len(calls) == 5
+
+
+def test_authentication_backend(app):
+    '''
+    Test authentication backends coalesce calls and bound their wait in the I/O pool
+    '''
+    import threading
+    import time
+    import backend_common.auth
+
+    backend = backend_common.auth.AuthenticationBackend('test', app=app, pool_size=2, timeout=0.5)
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def validate(token):
+        calls.append(token)
+        release.wait(5)
+        return token.upper()
+
+    threads = [
+        threading.Thread(target=lambda: results.append(backend.call('key', validate, 'token')))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ['token']
+    assert results == ['TOKEN'] * 3
+    assert backend.latency.stats()['count'] == 1
+
+    release.clear()
+    with pytest.raises(backend_common.auth.AuthenticationUnavailable):
+        backend.call('other', validate, 'token')
+    release.set()
+    backend.shutdown()
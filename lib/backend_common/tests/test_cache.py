@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+class FakeRedis(object):
+    '''
+    Redis client used by flask_caching's RedisCache, expiring keys like
+    redis does on a non-positive EXPIRE, and counting deleted keys
+    '''
+
+    def __init__(self):
+        self.data = dict()
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value):
+        self.data[name] = value
+        return True
+
+    def setex(self, name, value, time):
+        return self.set(name, value)
+
+    def setnx(self, name, value):
+        if name in self.data:
+            return False
+        return self.set(name, value)
+
+    def expire(self, name, time):
+        if name not in self.data:
+            return False
+        if time <= 0:
+            del self.data[name]
+        return True
+
+    def delete(self, *names):
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+
+def test_cache_heartbeat(app):
+    '''
+    Test the cache heartbeat probe succeeds
+    '''
+    import backend_common.cache
+
+    with app.app_context():
+        assert backend_common.cache.app_heartbeat() is None
+
+
+def test_cache_heartbeat_redis(app, monkeypatch):
+    '''
+    Test the cache heartbeat probe succeeds with a redis backend
+    '''
+    import flask_caching.backends.rediscache
+    import backend_common.cache
+
+    backend = flask_caching.backends.rediscache.RedisCache(host=FakeRedis())
+    monkeypatch.setitem(app.extensions['cache'], backend_common.cache.cache, backend)
+    with app.app_context():
+        assert backend_common.cache.app_heartbeat() is None
+
+
+def test_cache_stats(app):
+    '''
+    Test cache counters per backend and key prefix
+    '''
+    import backend_common.cache
+
+    backend = app.cache.cache
+    assert isinstance(backend, backend_common.cache.InstrumentedCache)
+    backend.prefixes.clear()
+
+    assert backend.get('auth0:userinfo:abc') is None
+    assert backend.set('auth0:userinfo:abc', 'value') is True
+    assert backend.get('auth0:userinfo:abc') == 'value'
+    assert backend.get_many('auth0:userinfo:abc', 'view//path') == ['value', None]
+    assert backend.delete('auth0:userinfo:abc') is True
+
+    with app.app_context():
+        stats = backend_common.cache.stats()
+    counters = stats['SimpleCache']
+    assert {
+        name: value
+        for name, value in counters['auth0'].items()
+        if name != 'latency'
+    } == dict(hits=2, misses=1, sets=1, deletes=1, errors=0)
+    assert counters['auth0']['latency']['count'] == 5
+    assert counters['view']['misses'] == 1
+
+    # Prefixes are bounded
+    backend.prefixes.clear()
+    backend.max_prefixes = 1
+    backend.get('a:1')
+    backend.get('b:1')
+    assert sorted(backend.stats().keys()) == ['a', 'other']
+    backend.max_prefixes = 100
+
+
+def test_tiered_cache():
+    '''
+    Test the local tier serves hot keys and is invalidated by other workers
+    '''
+    import json
+    import flask_caching.backends.simplecache
+    import backend_common.cache
+
+    class Client(object):
+        def __init__(self):
+            self.messages = []
+
+        def publish(self, channel, message):
+            self.messages.append(message)
+
+    remote = flask_caching.backends.simplecache.SimpleCache()
+    client = Client()
+    worker1 = backend_common.cache.TieredCache(remote, local_ttl=60, invalidation_client=client)
+    worker2 = backend_common.cache.TieredCache(remote, local_ttl=60, invalidation_client=client)
+
+    assert worker1.set('key', {'a': 1}) is True
+    assert worker2.get('key') == {'a': 1}
+
+    # Served by the local tier, as an independent copy
+    remote.delete('key')
+    value = worker2.get('key')
+    assert value == {'a': 1}
+    value['a'] = 2
+    assert worker2.get('key') == {'a': 1}
+    assert worker2.get_many('key', 'missing') == [{'a': 1}, None]
+
+    # Invalidation published by worker1, ignored by itself
+    assert worker1.set('key', 'new') is True
+    assert json.loads(client.messages[-1]) == dict(sender=worker1.id, keys=['key'])
+    worker1.invalidate(client.messages[-1])
+    assert worker1.local.get('key') is not None
+    assert worker2.get('key') == {'a': 1}
+    worker2.invalidate(client.messages[-1])
+    assert worker2.get('key') == 'new'
+
+    worker1.clear()
+    worker2.invalidate(client.messages[-1])
+    assert len(worker2.local) == 0
+    assert worker2.get('key') is None
+
+
+def test_tiered_cache_listener():
+    '''
+    Test the invalidation listener applies messages and can be stopped
+    '''
+    import json
+    import queue
+    import time
+    import flask_caching.backends.simplecache
+    import backend_common.cache
+
+    class PubSub(object):
+        def __init__(self):
+            self.messages = queue.Queue()
+
+        def subscribe(self, channel):
+            pass
+
+        def listen(self):
+            while True:
+                message = self.messages.get()
+                if message is None:
+                    return
+                yield message
+
+        def close(self):
+            self.messages.put(None)
+
+    class Client(object):
+        def __init__(self):
+            self.pubsubs = []
+
+        def pubsub(self, ignore_subscribe_messages=False):
+            self.pubsubs.append(PubSub())
+            return self.pubsubs[-1]
+
+        def publish(self, channel, message):
+            pass
+
+    remote = flask_caching.backends.simplecache.SimpleCache()
+    client = Client()
+    worker = backend_common.cache.TieredCache(remote, local_ttl=60, invalidation_client=client)
+    worker.listen()
+    while worker._pubsub is None:
+        time.sleep(0.01)
+    worker.set('key', 'value')
+    assert worker.local.get('key') is not None
+
+    message = json.dumps(dict(sender='other', keys=['key']))
+    worker._pubsub.messages.put(dict(type='message', data=message))
+    listener = worker._listener
+    worker.stop()
+    assert not listener.is_alive()
+    assert worker._listener is None
+    assert worker.local.get('key') is None
+    assert len(client.pubsubs) == 1
+
+    # Restarted in the parent after a fork
+    worker.listen()
+    while len(client.pubsubs) < 2:
+        time.sleep(0.01)
+    assert worker._listener.is_alive()
+    worker.stop()
+
+
+def test_tiered_cache_factory(app):
+    '''
+    Test the tiered backend can be configured through CACHE_TYPE
+    '''
+    import backend_common.cache
+
+    config = {
+        'CACHE_REMOTE_TYPE': 'simple',
+        'CACHE_LOCAL_SIZE': 10,
+        'CACHE_THRESHOLD': 500,
+        'CACHE_IGNORE_ERRORS': False,
+    }
+    backend = backend_common.cache.tiered(app, config, [], {'default_timeout': 30})
+    assert isinstance(backend, backend_common.cache.TieredCache)
+    assert backend.local.maxsize == 10
+    assert backend.set('key', 'value') is True
+    assert backend.remote.get('key') == 'value'
+
+
+def test_cached_response():
+    '''
+    Test API responses are cached, served with an ETag and invalidated
+    '''
+    import flask
+    import flask_login
+    import backend_common.cache
+
+    app = flask.Flask('test_cached_response')
+    flask_login.LoginManager().init_app(app)
+    backend_common.cache.init_app(app)
+    calls = []
+    items = dict(a=1)
+
+    @backend_common.cache.cached_response(timeout=60)
+    def get_item(name):
+        calls.append(name)
+        if name not in items:
+            return dict(error='missing'), 404
+        return dict(name=name, value=items[name])
+
+    @backend_common.cache.invalidates_responses(get_item)
+    def put_item(name):
+        items[name] += 1
+        return '', 204
+
+    app.add_url_rule('/items/<name>', 'get_item', get_item, methods=['GET'])
+    app.add_url_rule('/items/<name>', 'put_item', put_item, methods=['PUT'])
+    client = app.test_client()
+
+    resp = client.get('/items/a')
+    assert resp.status_code == 200
+    assert resp.json == dict(name='a', value=1)
+    etag = resp.headers['ETag']
+
+    resp = client.get('/items/a', headers=[('If-None-Match', etag)])
+    assert resp.status_code == 304
+    resp = client.get('/items/a?verbose=1')
+    assert resp.headers['ETag'] == etag
+    assert calls == ['a', 'a']
+
+    # Errors are not cached
+    assert client.get('/items/b').status_code == 404
+    assert client.get('/items/b').status_code == 404
+    assert calls == ['a', 'a', 'b', 'b']
+
+    assert client.put('/items/a').status_code == 204
+    resp = client.get('/items/a', headers=[('If-None-Match', etag)])
+    assert resp.status_code == 200
+    assert resp.json == dict(name='a', value=2)
+    assert resp.headers['ETag'] != etag
+
+
+def test_cached_response_permissions():
+    '''
+    Test permission checks applied above cached responses run on hits, and
+    cached responses vary on the user permissions
+    '''
+    import flask
+    import flask_login
+    import backend_common.cache
+
+    class User(object):
+        is_authenticated = True
+        is_active = True
+        is_anonymous = False
+
+        def __init__(self, permissions):
+            self.permissions = permissions
+
+        def get_id(self):
+            return 'user'
+
+        def get_permissions(self):
+            return self.permissions
+
+    user = User({'read'})
+    app = flask.Flask('test_cached_response_permissions')
+    login_manager = flask_login.LoginManager()
+    login_manager.init_app(app)
+    login_manager.request_loader(lambda request: user)
+    backend_common.cache.init_app(app)
+    calls = []
+
+    def require_read(operation):
+        def wrapper(*args, **kwargs):
+            if 'read' not in flask_login.current_user.get_permissions():
+                return flask.jsonify(error='forbidden'), 401
+            return operation(*args, **kwargs)
+        return wrapper
+
+    @require_read
+    @backend_common.cache.cached_response(timeout=60)
+    def get_item():
+        calls.append(sorted(flask_login.current_user.get_permissions()))
+        return dict(calls=len(calls))
+
+    app.add_url_rule('/item', 'get_item', get_item, methods=['GET'])
+    client = app.test_client()
+
+    assert client.get('/item').json == dict(calls=1)
+    assert client.get('/item').json == dict(calls=1)
+
+    # Another set of permissions is another response
+    user.permissions = {'read', 'write'}
+    assert client.get('/item').json == dict(calls=2)
+
+    # Revoked permissions are checked before the cache
+    user.permissions = set()
+    assert client.get('/item').status_code == 401
+    assert calls == [['read'], ['read', 'write']]
+
+
+def test_cached_response_redis():
+    '''
+    Test cached responses are served again by a redis backend
+    '''
+    import flask
+    import flask_caching.backends.rediscache
+    import flask_login
+    import backend_common.cache
+
+    app = flask.Flask('test_cached_response_redis')
+    flask_login.LoginManager().init_app(app)
+    backend_common.cache.init_app(app)
+    backend = flask_caching.backends.rediscache.RedisCache(host=FakeRedis())
+    app.extensions['cache'][backend_common.cache.cache] = backend
+    calls = []
+
+    @backend_common.cache.cached_response(timeout=60)
+    def get_item():
+        calls.append(True)
+        return dict(calls=len(calls))
+
+    app.add_url_rule('/item', 'get_item', get_item, methods=['GET'])
+    client = app.test_client()
+
+    assert client.get('/item').json == dict(calls=1)
+    assert client.get('/item').json == dict(calls=1)
+    assert len(calls) == 1
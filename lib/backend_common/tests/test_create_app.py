@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+
+def test_deferred_extensions():
+    '''
+    Test deferred extensions are initialised on first use, and profiled
+    '''
+    import backend_common
+
+    app = backend_common.create_app(
+        app_name='test_deferred_extensions',
+        project_name='Test',
+        extensions=['log', 'pulse', 'aws'],
+        config=backend_common.testing.get_app_config({
+            'PULSE_HOST': 'pulse.localhost',
+            'AWS': {'access_key_id': 'key'},
+            'STARTUP_PROFILE': True,
+        }),
+        redirect_root_to_api=False,
+    )
+
+    assert list(app.startup_profile.keys()) == ['log', 'total']
+    assert set(app.startup_profile['log'].keys()) == {'import_time', 'init_time'}
+    assert isinstance(app.pulse, backend_common.DeferredExtension)
+    assert isinstance(app.aws, backend_common.DeferredExtension)
+
+    # Initialised on first use
+    deferred = app.pulse
+    assert deferred.connection.hostname == 'pulse.localhost'
+    assert app.pulse.__class__.__name__ == 'Pulse'
+    assert deferred.load() is app.pulse
+    assert app.aws.config == {'access_key_id': 'key'}
+    assert app.aws.__class__.__name__ == 'AWS'
+    assert list(app.startup_profile.keys()) == ['log', 'total', 'pulse', 'aws']
+
+    # Deferral can be disabled
+    app = backend_common.create_app(
+        app_name='test_deferred_extensions',
+        project_name='Test',
+        extensions=['pulse'],
+        config=backend_common.testing.get_app_config({
+            'DEFERRED_EXTENSIONS': [],
+        }),
+        redirect_root_to_api=False,
+    )
+    assert app.pulse.__class__.__name__ == 'Pulse'
+
+    # Extensions not used through their app attribute cannot be deferred
+    with pytest.raises(Exception, match='Extensions cannot be deferred: log'):
+        backend_common.create_app(
+            app_name='test_deferred_extensions',
+            project_name='Test',
+            extensions=['log'],
+            config=backend_common.testing.get_app_config({
+                'DEFERRED_EXTENSIONS': ['log'],
+            }),
+            redirect_root_to_api=False,
+        )
+
+    app = backend_common.create_app(
+        app_name='test_deferred_extensions',
+        project_name='Test',
+        extensions=['log'],
+        config=backend_common.testing.get_app_config({}),
+        redirect_root_to_api=False,
+    )
+    app.log = backend_common.DeferredExtension(app, 'log')
+    with pytest.raises(Exception, match='did not set app.log'):
+        app.log.anything
+
+
+def test_fork_hooks(tmp_path):
+    '''
+    Test extensions release their connections before a fork, and are
+    usable in the forked process
+    '''
+    import os
+    import sqlalchemy.pool
+    import backend_common
+
+    app = backend_common.create_app(
+        app_name='test_fork_hooks',
+        project_name='Test',
+        extensions=['log', 'auth', 'db', 'pulse', 'aws'],
+        config=backend_common.testing.get_app_config({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'SQLALCHEMY_ENGINE_OPTIONS': {'poolclass': sqlalchemy.pool.QueuePool},
+            'AUTH_IO_POOL_SIZE': 2,
+        }),
+        redirect_root_to_api=False,
+    )
+    backend = app.auth.backends['taskcluster']
+    assert backend.call('key', lambda: 'master') == 'master'
+    aws = app.aws.load()
+    aws._queues['region', 'queue'] = object()
+
+    with app.app_context():
+        app.db.session.execute('SELECT 1')
+    assert app.db.get_engine(app).pool.checkedin() == 1
+
+    backend_common.before_fork(app)
+    assert app.db.get_engine(app).pool.checkedin() == 0
+    assert aws._queues == {}
+    # Never used, still deferred
+    assert isinstance(app.pulse, backend_common.DeferredExtension)
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            backend_common.after_fork(app)
+            with app.app_context():
+                app.db.session.execute('SELECT 1')
+            # The threads of the parent pool do not run here
+            if backend.call('key', lambda: 'worker') == 'worker':
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    # The parent keeps serving
+    backend_common.after_fork_parent(app)
+    with app.app_context():
+        app.db.session.execute('SELECT 1')
+    assert backend.call('key', lambda: 'parent') == 'parent'
+
+
+def test_fork_hooks_registration(monkeypatch):
+    '''
+    Test the garbage collector is frozen once, and registered fork hooks
+    only run in the master process and its direct children
+    '''
+    import gc
+    import os
+    import backend_common
+
+    app = backend_common.create_app(
+        app_name='test_fork_hooks_registration',
+        project_name='Test',
+        extensions=['log'],
+        config=backend_common.testing.get_app_config({
+            'FORK_GC_FREEZE': True,
+        }),
+        redirect_root_to_api=False,
+    )
+
+    freezes = []
+    monkeypatch.setattr(gc, 'freeze', lambda: freezes.append(True))
+    monkeypatch.setattr(backend_common, '_gc_frozen', False)
+    backend_common.before_fork(app)
+    backend_common.before_fork(app)
+    assert freezes == [True]
+
+    hooks = {}
+    calls = []
+    monkeypatch.setattr(os, 'register_at_fork', lambda **kwargs: hooks.update(kwargs))
+    monkeypatch.setattr(backend_common, 'before_fork', lambda app: calls.append('before'))
+    monkeypatch.setattr(backend_common, 'after_fork', lambda app: calls.append('after'))
+    monkeypatch.setattr(backend_common, 'after_fork_parent', lambda app: calls.append('parent'))
+    master_pid = os.getpid()
+    backend_common.register_fork_hooks(app)
+
+    hooks['before']()
+    hooks['after_in_parent']()
+    assert calls == ['before', 'parent']
+    monkeypatch.setattr(os, 'getpid', lambda: master_pid + 1)
+    monkeypatch.setattr(os, 'getppid', lambda: master_pid)
+    hooks['after_in_child']()
+    assert calls == ['before', 'parent', 'after']
+
+    # A worker forking
+    hooks['before']()
+    hooks['after_in_parent']()
+    monkeypatch.setattr(os, 'getppid', lambda: master_pid + 1)
+    hooks['after_in_child']()
+    assert calls == ['before', 'parent', 'after']
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+
+import pytest
+import werkzeug.exceptions
+
+import backend_common.db
+from backend_common.db import db
+
+
+class PaginatedItem(db.Model):
+    __tablename__ = 'test_paginated_items'
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime, nullable=False)
+
+
+@pytest.fixture
+def items(app):
+    with app.app_context():
+        PaginatedItem.__table__.create(db.engine, checkfirst=True)
+        start = datetime.datetime(2018, 1, 1)
+        for i in range(25):
+            # Pairs of items share their creation date
+            db.session.add(PaginatedItem(id=i + 1, created=start + datetime.timedelta(days=i // 2)))
+        db.session.commit()
+        yield
+        db.session.remove()
+        PaginatedItem.__table__.drop(db.engine)
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_paginate(app, items, descending):
+    '''
+    Test keyset pagination walks every row once, in order
+    '''
+    import backend_common.db
+
+    columns = [PaginatedItem.created, PaginatedItem.id]
+    expected = sorted(range(1, 26), reverse=descending)
+
+    ids = []
+    cursor = None
+    with app.app_context():
+        while True:
+            page = backend_common.db.paginate(PaginatedItem.query, columns, cursor=cursor, limit=10, descending=descending)
+            assert len(page.items) <= 10
+            ids.extend(item.id for item in page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+    assert ids == expected
+
+    with app.app_context():
+        page = backend_common.db.paginate(PaginatedItem.query, columns, limit=3)
+        # Cursors are bound to their ordering
+        with pytest.raises(werkzeug.exceptions.BadRequest):
+            backend_common.db.paginate(PaginatedItem.query, [PaginatedItem.id], cursor=page.next_cursor)
+        with pytest.raises(werkzeug.exceptions.BadRequest):
+            backend_common.db.paginate(PaginatedItem.query, columns, cursor='invalid')
+
+
+def test_cursor_values():
+    '''
+    Test cursors keep the type of their values
+    '''
+    import decimal
+    import uuid
+    import backend_common.db
+
+    values = [
+        datetime.datetime(2018, 1, 2, 3, 4, 5, 6),
+        datetime.datetime(2018, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+        datetime.date(2018, 1, 2),
+        decimal.Decimal('1.10'),
+        uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'name',
+        42,
+        None,
+    ]
+    columns = list(range(len(values)))
+    cursor = backend_common.db.encode_cursor(columns, values)
+    assert backend_common.db.decode_cursor(columns, cursor) == values
+    assert backend_common.db.decode_cursor(columns, cursor)[1].tzinfo == datetime.timezone.utc
+
+
+def test_pool_stats(app):
+    '''
+    Test the database pool publishes its metrics
+    '''
+    import backend_common.db
+
+    with app.app_context():
+        assert db.engine.pool.__class__.__name__ == 'InstrumentedStaticPool'
+        before = backend_common.db.pool_stats()
+        db.session.execute('SELECT 1').fetchall()
+        db.session.remove()
+        stats = backend_common.db.pool_stats()
+
+    assert stats['checkouts'] == before.get('checkouts', 0) + 1
+    assert stats['checkins'] == before.get('checkins', 0) + 1
+    assert stats['checkout_latency']['count'] == before['checkout_latency']['count'] + 1
+
+
+def test_instrument_queue_pool():
+    '''
+    Test overflows and timeouts of a queue pool are counted
+    '''
+    import sqlite3
+    import sqlalchemy.pool
+    import backend_common.db
+
+    pool = sqlalchemy.pool.QueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=1, timeout=0.1)
+    stats = backend_common.db.instrument_pool(pool)
+
+    first = pool.connect()
+    second = pool.connect()
+    with pytest.raises(sqlalchemy.exc.TimeoutError):
+        pool.connect()
+    first.close()
+    second.close()
+
+    # Survives the pool being recreated
+    pool = pool.recreate()
+    pool.connect().close()
+
+    assert pool.pool_stats is stats
+    result = stats.stats(pool)
+    assert result['checkouts'] == 3
+    assert result['overflows'] == 1
+    assert result['timeouts'] == 1
+    assert result['max_checked_out'] == 2
+    assert result['checkout_latency']['count'] == 4
+
+
+def test_query_instrumentation(monkeypatch):
+    '''
+    Test queries are counted per request and slow ones are logged
+    '''
+    import backend_common
+    import backend_common.db
+
+    app = backend_common.create_app(
+        app_name='test_query_instrumentation',
+        project_name='Test',
+        extensions=['db'],
+        config=backend_common.testing.get_app_config({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'DB_QUERY_INSTRUMENTATION': True,
+            'DB_SLOW_QUERY_THRESHOLD': 0,
+            'DEBUG': True,
+        }),
+    )
+    warnings = []
+    monkeypatch.setattr(backend_common.db.logger, 'warning', lambda message, **kwargs: warnings.append((message, kwargs)))
+
+    @app.route('/queries')
+    def queries():
+        for i in range(3):
+            app.db.session.execute('SELECT :value', dict(value=i)).fetchall()
+        return 'OK'
+
+    resp = app.test_client().get('/queries')
+    assert resp.status_code == 200
+    assert resp.headers['Server-Timing'].endswith('desc="3 queries"')
+    assert len(warnings) == 3
+    assert warnings[0][0] == 'Slow query'
+    assert warnings[0][1]['parameters'] == ['int']
+
+    assert backend_common.db.get_parameters_shape([('a', 1), ('b', 2)], executemany=True) == "2 x ['str', 'int']"
+
+
+class UniqueTag(backend_common.db.UniqueMixin, db.Model):
+    __tablename__ = 'test_unique_tags'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    name = db.Column(db.String(50), nullable=False)
+    __table_args__ = (db.UniqueConstraint('kind', 'name'), )
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    @classmethod
+    def unique_hash(cls, kind, name):
+        return (kind, name)
+
+    @classmethod
+    def unique_filter(cls, query, kind, name):
+        return query.filter(cls.kind == kind, cls.name == name)
+
+    @classmethod
+    def unique_columns(cls):
+        return [cls.kind, cls.name]
+
+    @classmethod
+    def unique_values(cls, kind, name):
+        return (kind, name)
+
+
+def test_as_unique_many(app):
+    '''
+    Test many unique objects are resolved with a constant number of queries
+    '''
+    statements = []
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0])
+
+    with app.app_context():
+        UniqueTag.__table__.create(db.engine, checkfirst=True)
+        existing = UniqueTag.as_unique(db.session, 'color', 'red')
+        db.session.commit()
+
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            arguments = [('color', 'red'), ('color', 'blue'), dict(kind='size', name='big'), ('color', 'blue')]
+            tags = UniqueTag.as_unique_many(db.session, arguments, batch_size=2)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+
+        assert [(tag.kind, tag.name) for tag in tags] == [('color', 'red'), ('color', 'blue'), ('size', 'big'), ('color', 'blue')]
+        assert tags[0] is existing
+        assert tags[1] is tags[3]
+        assert all(tag.id is not None for tag in tags)
+        # red is in the session cache, blue and big are one batch
+        assert statements == ['SELECT', 'INSERT', 'SELECT']
+
+        # Served by the session cache afterwards
+        assert UniqueTag.as_unique(db.session, 'size', 'big') is tags[2]
+        assert UniqueTag.as_unique_many(db.session, [('color', 'blue')]) == [tags[1]]
+        db.session.commit()
+        assert UniqueTag.query.count() == 3
+
+        db.session.remove()
+        UniqueTag.__table__.drop(db.engine)
+
+
+class UniqueProject(db.Model):
+    __tablename__ = 'test_unique_projects'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+
+
+class UniqueRelease(backend_common.db.UniqueMixin, db.Model):
+    __tablename__ = 'test_unique_releases'
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey(UniqueProject.id), nullable=False)
+    project = db.relationship(UniqueProject)
+    name = db.Column(db.String(50), nullable=False)
+    description = db.Column(db.String(50))
+    __table_args__ = (db.UniqueConstraint('project_id', 'name'), )
+
+    def __init__(self, project, name, description=None):
+        self.project = project
+        self.name = name
+        self.description = description
+
+    @classmethod
+    def unique_hash(cls, project, name, description=None):
+        return (project.id, name, description)
+
+    @classmethod
+    def unique_filter(cls, query, project, name, description=None):
+        return query.filter(cls.project_id == project.id, cls.name == name)
+
+    @classmethod
+    def unique_columns(cls):
+        return [cls.project_id, cls.name]
+
+    @classmethod
+    def unique_values(cls, project, name, description=None):
+        return (project.id, name)
+
+
+def test_as_unique_many_constructor(app):
+    '''
+    Test objects set by the constructor are inserted, and arguments sharing
+    unique values resolve to one object
+    '''
+    with app.app_context():
+        UniqueProject.__table__.create(db.engine, checkfirst=True)
+        UniqueRelease.__table__.create(db.engine, checkfirst=True)
+        project = UniqueProject(name='firefox')
+        db.session.add(project)
+        db.session.flush()
+
+        arguments = [(project, 'v1'), (project, 'v1', 'first'), dict(project=project, name='v2')]
+        releases = UniqueRelease.as_unique_many(db.session, arguments)
+        assert [release.project_id for release in releases] == [project.id] * 3
+        assert releases[0] is releases[1]
+        assert releases[2].name == 'v2'
+        db.session.commit()
+        assert UniqueRelease.query.count() == 2
+
+        db.session.remove()
+        UniqueRelease.__table__.drop(db.engine)
+        UniqueProject.__table__.drop(db.engine)
+
+
+class SharedTag(UniqueTag):
+    unique_shared = True
+
+
+def test_unique_identities(app):
+    '''
+    Test committed unique objects are shared between sessions
+    '''
+    statements = []
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0])
+
+    backend_common.db.unique_identities.clear()
+    with app.app_context():
+        UniqueTag.__table__.create(db.engine, checkfirst=True)
+        red = SharedTag.as_unique(db.session, 'color', 'red')
+        red_id = red.id
+        db.session.commit()
+        # Not shared when rolled back
+        SharedTag.as_unique(db.session, 'color', 'green')
+        db.session.rollback()
+        db.session.remove()
+        assert len(backend_common.db.unique_identities) == 1
+        # Nor when closed without a commit
+        SharedTag.as_unique(db.session, 'color', 'ghost')
+        db.session.remove()
+        db.session.commit()
+        db.session.remove()
+        assert len(backend_common.db.unique_identities) == 1
+
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            red = SharedTag.as_unique(db.session, 'color', 'red')
+            assert red.id == red_id
+            assert red.name == 'red'
+            assert SharedTag.as_unique_many(db.session, [('color', 'red')]) == [red]
+            assert statements == []
+            assert SharedTag.as_unique(db.session, 'color', 'green').id is not None
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+
+        db.session.delete(red)
+        db.session.commit()
+        assert backend_common.db.unique_identities.get((SharedTag, ('color', 'red'))) is None
+        assert backend_common.db.unique_identities.get((SharedTag, ('color', 'green'))) is not None
+
+        db.session.remove()
+        UniqueTag.__table__.drop(db.engine)
+
+
+def test_is_schema_at_head(app, tmpdir, monkeypatch):
+    '''
+    Test the schema version is checked against the migration heads
+    '''
+    import backend_common.db
+
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0, result.output
+
+    tmpdir.mkdir('versions').join('abc123_initial.py').write(
+        '\n'.join([
+            'revision = "abc123"',
+            'down_revision = None',
+            'branch_labels = None',
+            'depends_on = None',
+        ])
+    )
+    monkeypatch.setitem(app.config, 'DB_MIGRATIONS_DIR', str(tmpdir))
+    version_table = db.Table(
+        backend_common.db.VERSION_TABLE,
+        db.MetaData(),
+        db.Column('version_num', db.String(32), primary_key=True),
+    )
+
+    with app.app_context():
+        assert backend_common.db.is_schema_at_head(app) is False
+
+        version_table.create(db.engine)
+        try:
+            db.engine.execute(version_table.insert(), version_num='0ld')
+            assert backend_common.db.is_schema_at_head(app) is False
+            db.engine.execute(version_table.update(), version_num='abc123')
+            assert backend_common.db.is_schema_at_head(app) is True
+        finally:
+            version_table.drop(db.engine)
+
+
+def test_migrate_command(app, tmpdir, monkeypatch):
+    '''
+    Test `flask migrate` fails when a migration fails, and is not run twice
+    '''
+    import click
+    import flask_migrate
+
+    def upgrade(directory=None):
+        raise Exception('Broken migration')
+
+    monkeypatch.setitem(app.config, 'DB_MIGRATIONS_DIR', str(tmpdir))
+    monkeypatch.setattr(flask_migrate, 'upgrade', upgrade)
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 1
+    assert 'Migrations failure: Broken migration' in result.output
+
+    # Only logged when the application starts
+    with app.app_context():
+        backend_common.db.migrate_database(app)
+
+    monkeypatch.setattr('sys.argv', ['flask', 'migrate'])
+    assert backend_common.db.is_migrate_command() is False
+    with click.Context(click.Command('flask')):
+        assert backend_common.db.is_migrate_command() is True
+        monkeypatch.setattr('sys.argv', ['flask', 'db', 'migrate'])
+        assert backend_common.db.is_migrate_command() is False
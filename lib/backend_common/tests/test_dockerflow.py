@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import threading
+import time
+
+
+def test_heartbeat(app, client, monkeypatch):
+    '''
+    Test heartbeat checks run concurrently, with timeouts, and are cached
+    '''
+    import backend_common.dockerflow
+
+    calls = []
+
+    def ok():
+        calls.append('ok')
+
+    def failing():
+        raise backend_common.dockerflow.HeartbeatException('Cannot connect.')
+
+    def slow():
+        time.sleep(1)
+
+    heartbeat = backend_common.dockerflow.Heartbeat(app, [])
+    heartbeat.timeout = 0.2
+    heartbeat.cache_ttl = 60
+    heartbeat.checks = dict(db=ok, auth=failing, pulse=slow)
+    monkeypatch.setattr(app, 'heartbeat', heartbeat)
+
+    start = time.monotonic()
+    resp = client.get('/__heartbeat__')
+    assert time.monotonic() - start < 1
+    assert resp.status_code == 502
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['status'] == 'error'
+    assert data['checks']['db']['status'] == 'ok'
+    assert data['checks']['auth'] == dict(status='error', message='Cannot connect.', latency=data['checks']['auth']['latency'])
+    assert data['checks']['pulse']['message'] == 'Heartbeat timed out after 0.2s.'
+
+    # The result is cached
+    resp = client.get('/__heartbeat__')
+    assert resp.status_code == 502
+    assert calls == ['ok']
+
+    # A hanging check is not started again while it runs
+    hanging = threading.Event()
+    hangs = []
+
+    def hang():
+        hangs.append(True)
+        hanging.wait(5)
+
+    heartbeat = backend_common.dockerflow.Heartbeat(app, [])
+    heartbeat.timeout = 0.1
+    heartbeat.cache_ttl = 0
+    heartbeat.checks = dict(db=ok, pulse=hang)
+    for _ in range(3):
+        assert heartbeat.check()['checks']['pulse']['status'] == 'error'
+    assert len(hangs) == 1
+    assert calls == ['ok', 'ok', 'ok', 'ok']
+    hanging.set()
+    heartbeat._running['pulse'].result(timeout=5)
+    heartbeat.check()
+    assert len(hangs) == 2
+    heartbeat._pool.shutdown()
+
+    heartbeat = backend_common.dockerflow.Heartbeat(app, [])
+    heartbeat.checks = dict(db=ok)
+    monkeypatch.setattr(app, 'heartbeat', heartbeat)
+    resp = client.get('/__heartbeat__')
+    assert resp.status_code == 200
+    assert json.loads(resp.data.decode('utf-8'))['status'] == 'ok'
+
+
+def test_version(app, client, monkeypatch, tmpdir):
+    '''
+    Test the version document is served from memory with an ETag
+    '''
+    import os
+    import backend_common.dockerflow
+
+    path = tmpdir.join('version.json')
+    path.write(json.dumps({'source': 'src', 'version': '1.0', 'commit': 'abc', 'build': '1'}))
+    version = backend_common.dockerflow.Version(str(path), reload=True)
+    monkeypatch.setattr(app, 'version', version)
+
+    resp = client.get('/__version__')
+    assert resp.status_code == 200
+    assert json.loads(resp.data.decode('utf-8'))['version'] == '1.0'
+    etag = resp.headers['ETag']
+
+    resp = client.get('/__version__', headers=[('If-None-Match', etag)])
+    assert resp.status_code == 304
+
+    # Reloaded when the file changes
+    path.write(json.dumps({'source': 'src', 'version': '2.0', 'commit': 'def', 'build': '2'}))
+    os.utime(str(path), (version.mtime + 10, version.mtime + 10))
+    resp = client.get('/__version__', headers=[('If-None-Match', etag)])
+    assert resp.status_code == 200
+    assert json.loads(resp.data.decode('utf-8'))['version'] == '2.0'
+
+    # Invalid documents fall back on the defaults
+    path.write('not json')
+    version = backend_common.dockerflow.Version(str(path))
+    assert json.loads(version.body.decode('utf-8')) == backend_common.dockerflow.DEFAULT_VERSION
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import dataclasses
+import datetime
+import decimal
+import json
+import math
+import uuid
+
+import pytest
+
+import backend_common.encoder
+
+BACKENDS = [
+    name
+    for name, dumps in backend_common.encoder.BACKENDS.items()
+    if name == 'json' or dumps is not None
+]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_encoder(backend):
+    '''
+    Test every backend encodes the same documents
+    '''
+    data = {
+        'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'created': datetime.datetime(2018, 1, 2, 3, 4, 5, 6),
+        'updated': datetime.datetime(2018, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+        'day': datetime.date(2018, 1, 2),
+        'price': decimal.Decimal('1.5'),
+        'big': 2 ** 70,
+        'name': 'žluťoučký kůň',
+        1: [None, True, 1.5],
+    }
+    expected = {
+        'id': '12345678-1234-5678-1234-567812345678',
+        'created': '2018-01-02T03:04:05.000006Z',
+        'updated': '2018-01-02T03:04:05+00:00',
+        'day': '2018-01-02',
+        'price': 1.5,
+        'big': 2 ** 70,
+        'name': 'žluťoučký kůň',
+        '1': [None, True, 1.5],
+    }
+    assert backend_common.encoder.get_json_encoder(backend).backend == backend
+    assert json.loads(backend_common.encoder.dumps(data, backend=backend)) == expected
+
+    del data['big'], data[1]
+    encoded = backend_common.encoder.dumps(data, backend=backend, sort_keys=True)
+    assert list(json.loads(encoded).keys()) == sorted(str(key) for key in data.keys())
+
+    with pytest.raises(TypeError):
+        backend_common.encoder.dumps(object(), backend=backend)
+
+
+@dataclasses.dataclass
+class Point(object):
+    x: int
+    y: float
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_encoder_fallback(backend):
+    '''
+    Test every backend encodes dataclasses and non-finite numbers like
+    connexion's FlaskJSONEncoder
+    '''
+    assert json.loads(backend_common.encoder.dumps(Point(1, 2.5), backend=backend)) == {'x': 1, 'y': 2.5}
+
+    encoded = backend_common.encoder.dumps({'a': float('nan'), 'b': [None, float('inf')]}, backend=backend)
+    data = json.loads(encoded)
+    assert math.isnan(data['a'])
+    assert data['b'] == [None, float('inf')]
+    assert math.isnan(json.loads(backend_common.encoder.dumps({'a': decimal.Decimal('NaN')}, backend=backend))['a'])
+
+    with pytest.raises(ValueError):
+        backend_common.encoder.dumps([float('nan')], backend=backend, allow_nan=False)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Shared HTTP sessions, reusing connections between requests
+
+Every session created here keeps connections alive in a bounded pool per
+host, applies a default timeout to requests which do not set one, and
+retries failed connections (and idempotent requests answered by a 502, 503
+or 504) with an exponential backoff.
+'''
+
+import threading
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+from cli_common.log import get_logger
+
+logger = get_logger(__name__)
+
+# (connect, read) timeouts, in seconds
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+RETRY_STATUSES = (502, 503, 504)
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    '''
+    HTTP adapter using a default timeout for requests which do not set one
+    '''
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def create_session(timeout=DEFAULT_TIMEOUT,
+                   retries=DEFAULT_RETRIES,
+                   backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                   pool_connections=DEFAULT_POOL_CONNECTIONS,
+                   pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                   pool_block=False,
+                   ):
+    '''
+    Build a new HTTP session
+
+    pool_connections is the number of hosts whose connections are kept,
+    pool_maxsize the number of connections kept (or, with pool_block, the
+    maximum number of concurrent connections) per host.
+    '''
+    retry = urllib3.util.retry.Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(
+        timeout=timeout,
+        max_retries=retry,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(name='default', **options):
+    '''
+    Get the shared HTTP session registered under a name, creating it with
+    the provided options (see create_session) on first use
+    '''
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            logger.debug('Creating HTTP session', name=name)
+            session = _sessions[name] = create_session(**options)
+        return session
+
+
+def close_sessions():
+    '''
+    Close every shared session and their pooled connections
+    '''
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def release_connections():
+    '''
+    Close the pooled connections of every shared session, which remain
+    usable (e.g. in a forked process, not to share sockets with its parent)
+    '''
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    for session in sessions:
+        session.close()
+
+
+def session_stats(session):
+    '''
+    Connection pool statistics of a session, per host
+    '''
+    stats = dict()
+    for adapter in set(session.adapters.values()):
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            stats[f'{pool.scheme}://{pool.host}:{pool.port}'] = dict(
+                connections=pool.num_connections,
+                requests=pool.num_requests,
+                idle=pool.pool is not None and pool.pool.qsize() or 0,
+                maxsize=pool.pool is not None and pool.pool.maxsize or 0,
+            )
+    return stats
+
+
+def stats():
+    '''
+    Connection pool statistics of every shared session
+    '''
+    with _sessions_lock:
+        sessions = dict(_sessions)
+    return {
+        name: session_stats(session)
+        for name, session in sessions.items()
+    }
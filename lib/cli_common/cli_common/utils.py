@@ -3,7 +3,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import bisect
+import collections
 import concurrent.futures
+import threading
 import time
 
 import click
@@ -45,3 +48,159 @@ class ThreadPoolExecutorResult(concurrent.futures.ThreadPoolExecutor):
                 future.cancel()
             raise e
         return super(ThreadPoolExecutorResult, self).__exit__(*args)
+
+
+class TTLCache(object):
+    '''
+    Thread-safe LRU cache where every entry expires after a TTL
+
+    A maxsize of 0 disables the cache: nothing is stored and every lookup
+    is a miss. Hits, misses and evictions are counted so the cache can be
+    sized from real traffic (see `stats`).
+    '''
+
+    def __init__(self, maxsize=1024, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > self.timer():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, self.timer() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._data),
+            maxsize=self.maxsize,
+        )
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent calls sharing a key: the first caller runs the
+    operation, the others wait for its result (or exception) at most
+    `timeout` seconds
+    '''
+
+    def __init__(self):
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def call(self, key, operation, timeout=None):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+
+        if not leader:
+            return future.result(timeout=timeout)
+
+        try:
+            result = operation()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class Histogram(object):
+    '''
+    Thread-safe histogram of durations in seconds
+    '''
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        '''
+        Context manager observing the duration of its block
+        '''
+        histogram = self
+
+        class Timer(object):
+            def __enter__(self):
+                self.start = time.monotonic()
+
+            def __exit__(self, *args):
+                histogram.observe(time.monotonic() - self.start)
+
+        return Timer()
+
+    def stats(self):
+        '''
+        Cumulative counts per bucket upper bound, like Prometheus histograms
+        '''
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        buckets = collections.OrderedDict()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf', ), counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        return dict(
+            count=count,
+            sum=total,
+            buckets=buckets,
+        )
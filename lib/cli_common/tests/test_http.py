@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import requests.adapters
+
+import cli_common.http
+
+
+def test_default_timeout(monkeypatch):
+    sent = []
+
+    def send(adapter, request, **kwargs):
+        sent.append(kwargs['timeout'])
+        response = requests.models.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+    session = cli_common.http.create_session(timeout=(1, 2))
+    session.get('https://example.com')
+    session.get('https://example.com', timeout=10)
+    assert sent == [(1, 2), 10]
+
+
+def test_shared_sessions():
+    cli_common.http.close_sessions()
+    session = cli_common.http.get_session('test', pool_maxsize=3)
+    assert cli_common.http.get_session('test') is session
+    assert cli_common.http.get_session('other') is not session
+
+    session.get_adapter('https://example.com').get_connection('https://example.com')
+    assert cli_common.http.stats()['test'] == {
+        'https://example.com:443': dict(connections=0, requests=0, idle=3, maxsize=3),
+    }
+    cli_common.http.close_sessions()
+    assert cli_common.http.stats() == {}
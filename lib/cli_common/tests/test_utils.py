@@ -66,3 +66,78 @@ def test_threadpoolexecutorresult():
     assert f4.cancelled()
     assert f5.cancelled()
     assert f6.cancelled()
+
+
+def test_ttlcache():
+    now = [0]
+    cache = cli_common.utils.TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b' is the least recently used entry
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+    now[0] = 10
+    assert cache.get('a') is None
+
+    assert cache.stats() == dict(hits=2, misses=3, evictions=1, size=1, maxsize=2)
+
+    disabled = cli_common.utils.TTLCache(maxsize=0)
+    disabled.set('a', 1)
+    assert disabled.get('a') is None
+
+
+def test_singleflight():
+    import threading
+
+    flight = cli_common.utils.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def operation():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    leader = threading.Thread(target=lambda: results.append(flight.call('key', operation)))
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(target=lambda: results.append(flight.call('key', operation)))
+        for _ in range(3)
+    ]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == ['result'] * 4
+
+    # Exceptions are raised to the caller, and the key is released
+    with pytest.raises(Exception):
+        flight.call('key', do_raise)
+    assert flight.call('key', lambda: 'again') == 'again'
+
+
+def test_histogram():
+    histogram = cli_common.utils.Histogram(buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(2)
+    with histogram.time():
+        pass
+
+    stats = histogram.stats()
+    assert stats['count'] == 4
+    assert stats['buckets'] == {'0.1': 2, '1': 3, '+Inf': 4}
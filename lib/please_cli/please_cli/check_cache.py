@@ -8,9 +8,9 @@ import subprocess
 
 import click
 import click_spinner
-import requests
 
 import cli_common.command
+import cli_common.http
 import cli_common.log
 import please_cli.config
 import please_cli.utils
@@ -118,7 +118,7 @@ def cmd(project,
         with click_spinner.spinner():
             project_exists = False
             for cache_url in cache_urls:
-                response = requests.get(
+                response = cli_common.http.get_session().get(
                     '%s/%s.narinfo' % (cache_url, channel_derivations[nix_path_attribute].nix_hash),
                 )
                 project_exists = response.status_code == 200
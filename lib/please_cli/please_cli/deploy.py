@@ -13,10 +13,10 @@ import urllib
 import awscli.clidriver
 import click
 import click_spinner
-import requests
 import taskcluster.exceptions
 
 import cli_common.cli
+import cli_common.http
 import cli_common.log
 import cli_common.taskcluster
 import please_cli.build
@@ -337,7 +337,7 @@ def cmd_HEROKU(ctx,
             )
             if heroku_command:
                 update['command'] = heroku_command
-            r = requests.patch(
+            r = cli_common.http.get_session().patch(
                 f'https://api.heroku.com/apps/{heroku_app}/formation',
                 json=dict(updates=[update]),
                 headers={